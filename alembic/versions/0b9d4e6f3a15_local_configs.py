@@ -0,0 +1,33 @@
+"""local configs
+
+Revision ID: 0b9d4e6f3a15
+Revises: e7a93b61c2f0
+Create Date: 2026-10-18 16:20:45.871356
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0b9d4e6f3a15'
+down_revision = 'e7a93b61c2f0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'local_configs',
+        sa.Column('chip_id', sa.String(64), primary_key=True, nullable=False),
+        sa.Column('config_version', sa.Integer(), nullable=False),
+        sa.Column('payload', sa.LargeBinary(), nullable=False),
+        sa.Column('digest', sa.String(64), nullable=False),
+    )
+    op.create_index('local_config_version', 'local_configs',
+                    ['config_version'])
+
+
+def downgrade():
+    op.drop_index('local_config_version', 'local_configs')
+    op.drop_table('local_configs')
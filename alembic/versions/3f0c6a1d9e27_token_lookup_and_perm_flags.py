@@ -0,0 +1,36 @@
+"""token lookup and permission flags
+
+Revision ID: 3f0c6a1d9e27
+Revises: 8b3b42885014
+Create Date: 2026-10-18 10:12:41.532904
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f0c6a1d9e27'
+down_revision = '8b3b42885014'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('tokens', sa.Column('lookup', sa.String(32)))
+    op.add_column('tokens', sa.Column('perm_flags', sa.Integer(),
+                                      nullable=False, server_default='0'))
+    op.create_index('unique_token_lookup', 'tokens', ['lookup'], unique=True)
+    op.create_index('token_perm_flags', 'tokens', ['perm_flags'])
+    # lookup identifiers of existing tokens are filled in on first use
+    op.execute("UPDATE tokens SET perm_flags = "
+               "(CASE WHEN instr(permissions, 'r') > 0 THEN 1 ELSE 0 END) | "
+               "(CASE WHEN instr(permissions, 'w') > 0 THEN 2 ELSE 0 END) | "
+               "(CASE WHEN instr(permissions, 'a') > 0 THEN 4 ELSE 0 END)")
+
+
+def downgrade():
+    op.drop_index('token_perm_flags', 'tokens')
+    op.drop_index('unique_token_lookup', 'tokens')
+    op.drop_column('tokens', 'perm_flags')
+    op.drop_column('tokens', 'lookup')
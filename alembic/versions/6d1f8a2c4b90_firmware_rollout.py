@@ -0,0 +1,31 @@
+"""firmware rollout
+
+Revision ID: 6d1f8a2c4b90
+Revises: 0b9d4e6f3a15
+Create Date: 2026-10-18 17:12:45.118203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6d1f8a2c4b90'
+down_revision = '0b9d4e6f3a15'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('firmware', sa.Column('rollout_stages', sa.String(256)))
+    op.add_column('firmware', sa.Column('rollout_stage', sa.Integer(),
+                                        nullable=False, server_default='0'))
+    op.add_column('firmware', sa.Column('rollout_interval', sa.Integer()))
+    op.add_column('firmware', sa.Column('rollout_started', sa.Float()))
+
+
+def downgrade():
+    op.drop_column('firmware', 'rollout_started')
+    op.drop_column('firmware', 'rollout_interval')
+    op.drop_column('firmware', 'rollout_stage')
+    op.drop_column('firmware', 'rollout_stages')
@@ -0,0 +1,42 @@
+"""firmware catalog
+
+Revision ID: a41c7d2b5e83
+Revises: 3f0c6a1d9e27
+Create Date: 2026-10-18 14:02:17.118290
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a41c7d2b5e83'
+down_revision = '3f0c6a1d9e27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'firmware',
+        sa.Column('id', sa.Integer(), primary_key=True, autoincrement=True,
+                  nullable=False),
+        sa.Column('model', sa.String(64), nullable=False),
+        sa.Column('channel', sa.String(64), nullable=False),
+        sa.Column('version', sa.String(128), nullable=False),
+        sa.Column('file', sa.String(512), nullable=False),
+        sa.Column('size', sa.Integer(), nullable=False),
+        sa.Column('digest', sa.String(64), nullable=False),
+        sa.Column('created', sa.TIMESTAMP(), nullable=False,
+                  server_default=sa.func.current_timestamp()),
+    )
+    op.create_index('unique_firmware_version', 'firmware',
+                    ['model', 'channel', 'version'], unique=True)
+    op.create_index('firmware_newest', 'firmware',
+                    ['model', 'channel', 'id'])
+
+
+def downgrade():
+    op.drop_index('firmware_newest', 'firmware')
+    op.drop_index('unique_firmware_version', 'firmware')
+    op.drop_table('firmware')
@@ -0,0 +1,34 @@
+"""firmware delta
+
+Revision ID: c5e2f08a9d14
+Revises: a41c7d2b5e83
+Create Date: 2026-10-18 14:31:52.604417
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5e2f08a9d14'
+down_revision = 'a41c7d2b5e83'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'firmware_delta',
+        sa.Column('source_id', sa.Integer(), sa.ForeignKey('firmware.id'),
+                  nullable=False),
+        sa.Column('target_id', sa.Integer(), sa.ForeignKey('firmware.id'),
+                  nullable=False),
+        sa.Column('file', sa.String(512), nullable=False),
+        sa.Column('size', sa.Integer(), nullable=False),
+        sa.Column('digest', sa.String(64), nullable=False),
+        sa.PrimaryKeyConstraint('target_id', 'source_id'),
+    )
+
+
+def downgrade():
+    op.drop_table('firmware_delta')
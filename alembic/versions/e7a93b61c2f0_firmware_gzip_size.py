@@ -0,0 +1,24 @@
+"""firmware gzip size
+
+Revision ID: e7a93b61c2f0
+Revises: c5e2f08a9d14
+Create Date: 2026-10-18 14:58:03.210944
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7a93b61c2f0'
+down_revision = 'c5e2f08a9d14'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('firmware', sa.Column('gzip_size', sa.Integer()))
+
+
+def downgrade():
+    op.drop_column('firmware', 'gzip_size')
@@ -22,6 +22,37 @@ def create_app(test_config=None):
     app.config.from_mapping(
         SECRET_KEY='dev',
         DATABASE=os.path.join(app.instance_path, 'iota.sqlite'),
+        TOKEN_CACHE_SIZE=1024,
+        TOKEN_CACHE_TTL=300,
+        TOKEN_LEGACY_SCAN=False,
+        PWHASH_WORKERS=2,
+        PWHASH_MAX_INFLIGHT=16,
+        PWHASH_RETRY_AFTER=1,
+        PWHASH_OPSLIMIT=None,
+        PWHASH_MEMLIMIT=None,
+        SESSION_KEY=None,
+        SESSION_TTL=300,
+        FIRMWARE_CATALOG_CHECK_INTERVAL=1.0,
+        FIRMWARE_DEFAULT_MODEL="esp8266",
+        FIRMWARE_DEFAULT_CHANNEL="stable",
+        FIRMWARE_DELTA_DEPTH=3,
+        UPLOAD_TTL=24 * 60 * 60,
+        UPLOAD_MAX_SESSIONS=16,
+        UPLOAD_MAX_SIZE=16 * 1024 * 1024,
+        GLOBAL_CONFIG_CACHE_SIZE=16,
+        LOCAL_CONFIG_BULK_BATCH=500,
+        LOCAL_CONFIG_BULK_MAX_ENTRY=64 * 1024,
+        CHECKIN_INLINE_MAX=512,
+        LONGPOLL_TIMEOUT=60,
+        LONGPOLL_SYNC_TIMEOUT=0,
+        ASGI_THREADS=16,
+        FIRMWARE_MAX_TRANSFERS=None,
+        FIRMWARE_MAX_RATE=None,
+        FIRMWARE_RETRY_AFTER=30,
+        POLL_INTERVAL=300,
+        POLL_INTERVAL_MIN=30,
+        POLL_TARGET_RATE=None,
+        POLL_POLICY=None,
     )
 
     if test_config is None:
@@ -41,16 +72,27 @@ def create_app(test_config=None):
     def landing():
         return 'Hello, World!'
 
+    from .notify import init_app as notify_init_app
+    notify_init_app(app)
+
     from . import token
     app.register_blueprint(token.bp)
+    token.init_app(app)
 
     from . import deploy
     app.register_blueprint(deploy.bp)
 
     from . import serve
     app.register_blueprint(serve.bp)
+    serve.init_app(app)
 
     from .db import init_app as db_init_app
     db_init_app(app)
 
+    from .firmware import init_app as firmware_init_app
+    firmware_init_app(app)
+
+    from .local_config import init_app as local_config_init_app
+    local_config_init_app(app)
+
     return app
@@ -0,0 +1,212 @@
+#
+# (C) Copyright 2021 Tillmann Heidsieck
+#
+# SPDX-License-Identifier: MIT
+#
+"""ASGI entry point
+
+The Flask application is run unchanged on a bounded thread pool, one step
+at a time: producing the response headers, and then each chunk of the
+body. Between the steps the request is only a coroutine on the event loop,
+so slow clients downloading firmware do not pin a thread for the whole
+transfer. Long polls wait on the event loop as well.
+
+Run with any ASGI server, e.g.
+
+    uvicorn --factory iota.asgi:create_asgi_app
+"""
+import asyncio
+import concurrent.futures
+import sys
+
+from werkzeug.wsgi import FileWrapper
+
+from iota import create_app
+from iota.firmware import CHUNK_SIZE
+
+_END = object()
+
+
+class _BodyReader:
+    """wsgi.input pulling the request body from an ASGI receive channel
+
+    Only used from the thread pool, each read blocks the calling thread
+    until the event loop delivered the next message.
+    """
+    def __init__(self, receive, loop):
+        self._receive = receive
+        self._loop = loop
+        self._buf = b""
+        self._eof = False
+
+    def _fill(self):
+        message = asyncio.run_coroutine_threadsafe(self._receive(),
+                                                   self._loop).result()
+        if message["type"] == "http.disconnect":
+            raise OSError("client disconnected")
+        self._buf += message.get("body", b"")
+        self._eof = not message.get("more_body", False)
+
+    def _take(self, n):
+        data, self._buf = self._buf[:n], self._buf[n:]
+        return data
+
+    def read(self, size=-1):
+        while not self._eof and (size is None or size < 0 or
+                                 len(self._buf) < size):
+            self._fill()
+        if size is None or size < 0:
+            size = len(self._buf)
+        return self._take(size)
+
+    def readline(self, size=-1):
+        while not self._eof and b"\n" not in self._buf and \
+                (size is None or size < 0 or len(self._buf) < size):
+            self._fill()
+        n = self._buf.find(b"\n") + 1 or len(self._buf)
+        if size is not None and size >= 0:
+            n = min(n, size)
+        return self._take(n)
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+
+def _file_wrapper(f, buffer_size=8192):
+    return FileWrapper(f, max(buffer_size, CHUNK_SIZE))
+
+
+def _environ(scope, body):
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode().decode("latin-1"),
+        "PATH_INFO": scope["path"].encode().decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/%s" % (scope.get("http_version", "1.1")),
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        "wsgi.input_terminated": True,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+        "wsgi.file_wrapper": _file_wrapper,
+    }
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = "HTTP_" + name
+        if name in environ:
+            value = environ[name] + "," + value
+        environ[name] = value
+    return environ
+
+
+class AsgiApp:
+    """ASGI application serving a Flask app from a thread pool"""
+    def __init__(self, app, threads=None):
+        self.app = app
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            threads or app.config["ASGI_THREADS"],
+            thread_name_prefix="iota-asgi")
+
+    @property
+    def hub(self):
+        return self.app.extensions["iota_notify"]
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    def _start(self, environ):
+        """Call the WSGI app and produce the status and the first chunk"""
+        response = []
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response[:] = [status, headers]
+
+        body = self.app(environ, start_response)
+        try:
+            it = iter(body)
+            first = next(it, _END)
+        except BaseException:
+            if hasattr(body, "close"):
+                body.close()
+            raise
+        return response[0], response[1], body, it, first
+
+    @staticmethod
+    def _close(body):
+        if hasattr(body, "close"):
+            body.close()
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self._lifespan(receive, send)
+        if scope["type"] != "http":
+            raise ValueError("unsupported scope %s" % (scope["type"]))
+
+        loop = asyncio.get_running_loop()
+        environ = _environ(scope, _BodyReader(receive, loop))
+        while True:
+            wait = {}
+            status, headers, body, it, first = await self._run(
+                self._start, dict(environ, **{"iota.wait": wait}))
+            if not wait:
+                break
+
+            # a long poll without news, wait here instead of in a thread
+            await self._run(self._close, body)
+            start = loop.time()
+            changed = await self.hub.wait_async(wait["since"],
+                                                wait["timeout"])
+            remaining = wait["timeout"] - (loop.time() - start)
+            environ["HTTP_X_POLL_TIMEOUT"] = \
+                str(max(0, remaining) if changed else 0)
+
+        try:
+            code, _, _ = status.partition(" ")
+            await send({
+                "type": "http.response.start",
+                "status": int(code),
+                "headers": [(k.lower().encode("latin-1"),
+                             v.encode("latin-1")) for k, v in headers],
+            })
+            chunk = first
+            while chunk is not _END:
+                if chunk:
+                    await send({"type": "http.response.body", "body": chunk,
+                                "more_body": True})
+                chunk = await self._run(next, it, _END)
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            await self._run(self._close, body)
+
+
+def create_asgi_app(test_config=None):
+    """Create the Flask app of create_app() and serve it as ASGI app"""
+    return AsgiApp(create_app(test_config))
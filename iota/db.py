@@ -20,6 +20,8 @@ def get_db():
             detect_types=sqlite3.PARSE_DECLTYPES
         )
         g.db.row_factory = sqlite3.Row
+        # readers see the last commit while a deploy holds the write lock
+        g.db.execute("PRAGMA journal_mode=WAL")
 
     return g.db
 
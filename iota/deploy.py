@@ -4,11 +4,22 @@
 # SPDX-License-Identifier: MIT
 #
 import base64
+import binascii
+import codecs
+import contextlib
+import fcntl
+import hashlib
 import json
 import nacl.pwhash
 import nacl.utils
 import os
 import re
+import secrets
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
 
 from flask import (
     Blueprint,
@@ -17,62 +28,103 @@ from flask import (
 )
 from flask_api import status
 
-from iota.token import verify
+from iota.files import write_atomic
+from iota.firmware import (
+    CHUNK_SIZE,
+    VersionConflict,
+    add_firmware,
+    advance_rollout,
+    parse_rollout,
+    publish_image,
+    query_newest,
+    rollout_percent,
+    rollout_stage,
+    store_image,
+)
+from iota.local_config import store_local_config, store_local_configs
+from iota.notify import GLOBAL_CONFIG_TOPIC, notify
+from iota.token import authorized
+from iota.version import (  # noqa: F401
+    keycmp,
+    v2l,
+    vercmp,
+    verkey,
+)
 
 
-def _verprep(v):
-    v = v.lstrip().rstrip()
-    v = re.sub(r"[^0-9._+-]+?", "", v)
-    return v
+def digest(data):
+    return hashlib.sha256(data).hexdigest()
 
 
-def v2l(v):
-    as_list = v.split(".")
-    for i in range(0, len(as_list)):
-        as_list[i] = re.sub(r"[_+-]+?", ".", as_list[i])
-        as_list[i] = as_list[i].split(".")
+_deploy_mutex = threading.Lock()
 
-    for i in range(0, len(as_list)):
-        for j in range(0, len(as_list[i])):
-            if re.match(r"[0-9]+", as_list[i][j]):
-                as_list[i][j] = int(as_list[i][j])
 
-    return as_list
+@contextlib.contextmanager
+def deploy_lock():
+    """Serialize read-modify-write deploys across threads and processes"""
+    with _deploy_mutex:
+        with open(os.path.join(current_app.instance_path, "deploy.lock"),
+                  "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
 
 
-def vercmp(v1, v2):
-    v1 = v2l(_verprep(v1))
-    v2 = v2l(_verprep(v2))
+def meta_file(path):
+    """Name of the plaintext metadata sidecar of the artifact at `path`"""
+    return path + ".meta"
 
-    cmp = 0
-    for i in range(0, min(len(v1), len(v2))):
-        for j in range(0, min(len(v1[i]), len(v2[i]))):
-            if v1[i][j] < v2[i][j]:
-                cmp = 1
-                break
-            elif v1[i][j] > v2[i][j]:
-                cmp = -1
-                break
-        if cmp == 0 and len(v1[i]) != len(v2[i]):
-            cmp = 1 if len(v1) < len(v2) else -1
-        if cmp != 0:
-            break
-
-    if cmp == 0 and len(v1) == len(v2):
-        return 0
-    elif cmp == 0 and len(v1) != len(v2):
-        return 1 if len(v1) < len(v2) else -1
-    else:
-        return cmp
 
+_UPLOAD_ID = re.compile(r"[0-9a-f]{32}")
 
 bp = Blueprint('deploy', __name__, url_prefix='/api/v1/deploy')
 
 
+def firmware_target():
+    """Hardware model and release channel addressed by a request"""
+    model = request.headers.get("X-firmware-model") or \
+        current_app.config["FIRMWARE_DEFAULT_MODEL"]
+    channel = request.headers.get("X-firmware-channel") or \
+        current_app.config["FIRMWARE_DEFAULT_CHANNEL"]
+    return model, channel
+
+
+def rollout_plan():
+    """Staged rollout requested by X-firmware-rollout, raises ValueError"""
+    stages = request.headers.get("X-firmware-rollout")
+    if not stages:
+        return None
+    return parse_rollout(stages,
+                         request.headers.get("X-firmware-rollout-interval"))
+
+
+def _rollout(manifest):
+    if manifest.rollout is None:
+        return None
+    return {"stages": manifest.rollout.stages,
+            "stage": rollout_stage(manifest),
+            "interval": manifest.rollout.interval,
+            "percent": rollout_percent(manifest)}
+
+
+def _deployed(manifest, deltas):
+    return {"firmware": "successfully deployed",
+            "model": manifest.model,
+            "channel": manifest.channel,
+            "version": manifest.version,
+            "rollout": _rollout(manifest),
+            "deltas": deltas,
+            "compression": {
+                "gzip": round(manifest.gzip_size / manifest.size, 3)
+                if manifest.gzip_size else None,
+            }}, status.HTTP_201_CREATED
+
+
 @bp.route('/firmware', methods=['PUT'])
 def deploy_firmware():
-    token = request.headers.get("X-auth-token")
-    if not verify(token, access="w"):
+    if not authorized("w"):
         return {'deploy': 'not authorized'}, status.HTTP_401_UNAUTHORIZED
 
     new_version = request.headers.get("X-firmware_version")
@@ -80,88 +132,495 @@ def deploy_firmware():
         return {"deploy": "no firmware version specified"},\
             status.HTTP_400_BAD_REQUEST
 
-    config_file = os.path.join(current_app.instance_path, "firmware.json")
     try:
-        with open(config_file, "rb") as f:
-            j = json.load(f)
-    except OSError:
-        j = {"version": "0.0"}
-    except json.JSONDecodeError:
-        j = {"version": "0.0"}
+        rollout = rollout_plan()
+    except ValueError:
+        return {"deploy": "invalid rollout"}, status.HTTP_400_BAD_REQUEST
 
-    if "version" in j.keys():
-        current_version = j["version"]
+    model, channel = firmware_target()
+    current = query_newest(model, channel)
+    current_version = current.version if current else "0.0"
 
     if vercmp(current_version, new_version) <= 0:
         return {'deploy': 'current firmware version >= new firmware version'},\
             status.HTTP_304_NOT_MODIFIED
 
-    new_firmware = base64.b64decode(request.get_data())
+    # raw images are taken as they are, everything else as base64
+    encoded = request.mimetype != "application/octet-stream"
     # TODO test signature
-    firmware_name = "firmware.sig"
-    firmware_file = os.path.join(current_app.instance_path, firmware_name)
-    j = {"version": new_version, "file": firmware_name}
     try:
-        with open(firmware_file, "wb") as f:
-            f.write(new_firmware)
-        with open(config_file, "w") as f:
-            f.write(json.dumps(j, indent=4))
+        manifest, deltas = add_firmware(model, channel, new_version,
+                                        request.stream, encoded, rollout)
+    except VersionConflict:
+        return {'deploy': 'current firmware version >= new firmware version'},\
+            status.HTTP_304_NOT_MODIFIED
+    except binascii.Error:
+        return {"firmware": "invalid base64 encoding"}, \
+            status.HTTP_400_BAD_REQUEST
+    except (OSError, sqlite3.Error) as e:
+        print(e)
+        return {"firmware": "failed to write new firmware"}, \
+            status.HTTP_500_INTERNAL_SERVER_ERROR
+
+    return _deployed(manifest, deltas)
+
+
+def _uploads_dir():
+    return os.path.join(current_app.instance_path, "uploads")
+
+
+def _upload_meta(path):
+    """Return the upload.json of an upload, None if broken or expired"""
+    try:
+        with open(os.path.join(path, "upload.json"), "rb") as f:
+            j = json.load(f)
+        created = float(j["created"])
+        j["version"], j["model"], j["channel"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+    if created + current_app.config["UPLOAD_TTL"] < time.time():
+        return None
+    return j
+
+
+def _upload(upload_id):
+    """Return the path and upload.json of a live upload or (None, None)"""
+    if not _UPLOAD_ID.fullmatch(upload_id):
+        return None, None
+    path = os.path.join(_uploads_dir(), upload_id)
+    if not os.path.isdir(path):
+        return None, None
+
+    meta = _upload_meta(path)
+    if meta is None:
+        shutil.rmtree(path, ignore_errors=True)
+        return None, None
+    return path, meta
+
+
+def _expire_uploads():
+    """Remove expired and broken uploads, return the number of live ones
+
+    Uploads are assembled in a directory starting with a dot and renamed
+    into place once complete, those are only removed after UPLOAD_TTL.
+    """
+    try:
+        names = os.listdir(_uploads_dir())
+    except OSError:
+        return 0
+
+    live = 0
+    for name in names:
+        path = os.path.join(_uploads_dir(), name)
+        if name.startswith("."):
+            try:
+                if os.path.getmtime(path) + \
+                        current_app.config["UPLOAD_TTL"] >= time.time():
+                    continue
+            except OSError:
+                continue
+        elif _upload_meta(path) is not None:
+            live += 1
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+    return live
+
+
+def _upload_chunks(path):
+    return sorted(int(f[:-len(".chunk")]) for f in os.listdir(path)
+                  if f.endswith(".chunk"))
+
+
+class _ChunkReader:
+    """File-like reader over a sequence of chunk files"""
+    def __init__(self, paths):
+        self._paths = iter(paths)
+        self._f = None
+
+    def read(self, size=-1):
+        while True:
+            if self._f is None:
+                path = next(self._paths, None)
+                if path is None:
+                    return b""
+                self._f = open(path, "rb")
+            data = self._f.read(size)
+            if data:
+                return data
+            self._f.close()
+            self._f = None
+
+
+@bp.route('/firmware/upload', methods=['POST'])
+def create_upload():
+    if not authorized("w"):
+        return {'deploy': 'not authorized'}, status.HTTP_401_UNAUTHORIZED
+
+    new_version = request.headers.get("X-firmware_version")
+    if not new_version:
+        return {"deploy": "no firmware version specified"},\
+            status.HTTP_400_BAD_REQUEST
+
+    try:
+        rollout = rollout_plan()
+    except ValueError:
+        return {"deploy": "invalid rollout"}, status.HTTP_400_BAD_REQUEST
+
+    model, channel = firmware_target()
+    current = query_newest(model, channel)
+    if current and vercmp(current.version, new_version) <= 0:
+        return {'deploy': 'current firmware version >= new firmware version'},\
+            status.HTTP_304_NOT_MODIFIED
+
+    if _expire_uploads() >= current_app.config["UPLOAD_MAX_SESSIONS"]:
+        return {"upload": "too many open uploads"}, \
+            status.HTTP_429_TOO_MANY_REQUESTS
+
+    upload_id = secrets.token_hex(16)
+    path = os.path.join(_uploads_dir(), upload_id)
+    try:
+        os.makedirs(_uploads_dir(), exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=_uploads_dir(), prefix=".")
+        with open(os.path.join(tmp, "upload.json"), "w") as f:
+            json.dump({"version": new_version, "model": model,
+                       "channel": channel, "rollout": rollout,
+                       "created": time.time()}, f)
+        os.rename(tmp, path)
     except OSError as e:
+        print(e)
+        return {"upload": "failed to create upload"}, \
+            status.HTTP_500_INTERNAL_SERVER_ERROR
+
+    return {"upload": upload_id}, status.HTTP_201_CREATED
+
+
+@bp.route('/firmware/upload/<upload_id>', methods=['GET', 'DELETE'])
+def upload_status(upload_id):
+    if not authorized("w"):
+        return {'deploy': 'not authorized'}, status.HTTP_401_UNAUTHORIZED
+
+    path, _ = _upload(upload_id)
+    if not path:
+        return {"upload": "not found"}, status.HTTP_404_NOT_FOUND
+
+    if request.method == "DELETE":
+        shutil.rmtree(path, ignore_errors=True)
+        return {}, status.HTTP_202_ACCEPTED
+
+    return {"upload": upload_id, "chunks": _upload_chunks(path)}, \
+        status.HTTP_200_OK
+
+
+@bp.route('/firmware/upload/<upload_id>/<int:chunk>', methods=['PUT'])
+def upload_chunk(upload_id, chunk):
+    if not authorized("w"):
+        return {'deploy': 'not authorized'}, status.HTTP_401_UNAUTHORIZED
+
+    path, _ = _upload(upload_id)
+    if not path:
+        return {"upload": "not found"}, status.HTTP_404_NOT_FOUND
+
+    chunk_digest = request.headers.get("X-chunk-digest")
+    if not chunk_digest:
+        return {"upload": "no chunk digest given"}, \
+            status.HTTP_400_BAD_REQUEST
+
+    # bytes left for this chunk, a chunk sent again replaces the old one
+    room = current_app.config["UPLOAD_MAX_SIZE"] - sum(
+        os.path.getsize(os.path.join(path, "%d.chunk" % (c)))
+        for c in _upload_chunks(path) if c != chunk)
+
+    sha256 = hashlib.sha256()
+    tmp = os.path.join(path, "%d.part" % (chunk))
+    try:
+        with open(tmp, "wb") as f:
+            while True:
+                data = request.stream.read(CHUNK_SIZE)
+                if not data:
+                    break
+                room -= len(data)
+                if room < 0:
+                    break
+                sha256.update(data)
+                f.write(data)
+
+        if room < 0:
+            os.unlink(tmp)
+            return {"upload": "upload too large"}, \
+                status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+
+        if sha256.hexdigest() != chunk_digest.lower():
+            os.unlink(tmp)
+            return {"upload": "chunk digest mismatch"}, \
+                status.HTTP_400_BAD_REQUEST
+
+        os.replace(tmp, os.path.join(path, "%d.chunk" % (chunk)))
+    except OSError as e:
+        print(e)
+        return {"upload": "failed to write chunk"}, \
+            status.HTTP_500_INTERNAL_SERVER_ERROR
+
+    return {"upload": upload_id, "chunk": chunk}, status.HTTP_201_CREATED
+
+
+@bp.route('/firmware/upload/<upload_id>/commit', methods=['POST'])
+def commit_upload(upload_id):
+    if not authorized("w"):
+        return {'deploy': 'not authorized'}, status.HTTP_401_UNAUTHORIZED
+
+    path, j = _upload(upload_id)
+    if not path:
+        return {"upload": "not found"}, status.HTTP_404_NOT_FOUND
+
+    chunks = _upload_chunks(path)
+    if not chunks or chunks != list(range(0, len(chunks))):
+        return {"upload": "missing chunks", "chunks": chunks}, \
+            status.HTTP_409_CONFLICT
+
+    reader = _ChunkReader(os.path.join(path, "%d.chunk" % (c))
+                          for c in chunks)
+    try:
+        tmp, size, digest = store_image(reader)
+        image_digest = request.headers.get("X-firmware-digest")
+        if image_digest and image_digest.lower() != digest:
+            os.unlink(tmp)
+            return {"upload": "firmware digest mismatch"}, \
+                status.HTTP_400_BAD_REQUEST
+        try:
+            manifest, deltas = publish_image(j["model"], j["channel"],
+                                             j["version"], tmp, size, digest,
+                                             j.get("rollout"))
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+    except VersionConflict:
+        shutil.rmtree(path, ignore_errors=True)
+        return {'deploy': 'current firmware version >= new firmware version'},\
+            status.HTTP_304_NOT_MODIFIED
+    except (OSError, sqlite3.Error) as e:
         print(e)
         return {"firmware": "failed to write new firmware"}, \
             status.HTTP_500_INTERNAL_SERVER_ERROR
 
-    return {"firmware": "successfully deployed"},\
-        status.HTTP_201_CREATED
+    shutil.rmtree(path, ignore_errors=True)
+    return _deployed(manifest, deltas)
+
+
+@bp.route('/firmware/rollout', methods=['PUT'])
+def deploy_rollout():
+    """Advance the staged rollout of a firmware version
+
+    Takes {"version": ..., "stage": n}, without a stage the rollout moves
+    to its next stage.
+    """
+    if not authorized("w"):
+        return {'deploy': 'not authorized'}, status.HTTP_401_UNAUTHORIZED
+
+    j = request.get_json(silent=True)
+    if not isinstance(j, dict) or not j.get("version"):
+        return {"rollout": "no firmware version specified"}, \
+            status.HTTP_400_BAD_REQUEST
+
+    stage = j.get("stage")
+    if stage is not None and (not isinstance(stage, int) or
+                              isinstance(stage, bool)):
+        return {"rollout": "invalid stage"}, status.HTTP_400_BAD_REQUEST
+
+    model, channel = firmware_target()
+    try:
+        manifest = advance_rollout(model, channel, j["version"], stage)
+    except KeyError:
+        return {"rollout": "firmware version not found"}, \
+            status.HTTP_404_NOT_FOUND
+    except ValueError:
+        return {"rollout": "invalid stage"}, status.HTTP_400_BAD_REQUEST
+    except sqlite3.Error as e:
+        print(e)
+        return {"rollout": "failed to update rollout"}, \
+            status.HTTP_500_INTERNAL_SERVER_ERROR
+
+    return {"version": manifest.version, "rollout": _rollout(manifest)}, \
+        status.HTTP_200_OK
 
 
 @bp.route('/local_config', methods=['PUT'])
 def deploy_local_config():
-    token = request.headers.get("X-auth-token")
-    if not verify(token, access="w"):
+    if not authorized("w"):
         return {'deploy': 'not authorized'}, status.HTTP_401_UNAUTHORIZED
 
     chip_id = request.headers.get("X-chip-id")
     if not chip_id:
         return {'local_config': 'no CHIP ID given'}, status.HTTP_404_NOT_FOUND
 
-    local_conf = None
-    config_file = os.path.join(current_app.instance_path,
-                               "config.json.%s" % (chip_id))
+    new_config = request.get_json()
+    if not isinstance(new_config, dict):
+        return {'local_config': 'invalid config'}, status.HTTP_400_BAD_REQUEST
+
     try:
-        with open(config_file, "rb") as f:
-            local_conf = f.read()
-    except OSError:
-        local_conf = b"{'config_version': 0}"
+        store_local_config(chip_id, new_config)
+    except sqlite3.Error as e:
+        print(e)
+        return {'local_config': 'failed to write config'}, \
+            status.HTTP_500_INTERNAL_SERVER_ERROR
 
+    return {'local_config': 'successfully deployed'}, status.HTTP_201_CREATED
+
+
+class EntryTooLarge(Exception):
+    """Raised when an entry of a bulk deploy exceeds its size limit"""
+
+
+def _ndjson_entries(stream, max_entry):
+    while True:
+        line = stream.readline(max_entry + 1)
+        if not line:
+            return
+        if len(line.rstrip(b"\r\n")) > max_entry:
+            raise EntryTooLarge()
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_NUMBER_TAIL = re.compile(r"[0-9.eE+-]*")
+
+# what _json_array_entries() expects next
+_OPEN, _FIRST, _VALUE, _SEPARATOR, _CLOSED = range(5)
+
+
+def _json_array_entries(stream, max_entry):
+    """Decode the elements of a JSON array one by one from a stream
+
+    An element spanning several reads is only decoded again once its text
+    doubled, so decoding stays linear in the size of the body. Elements
+    longer than `max_entry` characters raise EntryTooLarge, anything but
+    whitespace after the closing bracket raises ValueError.
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8")()
+    buf = ""
+    pos = 0
+    eof = False
+    expected = _OPEN
+    while True:
+        pos = _WHITESPACE.match(buf, pos).end()
+        if pos < len(buf):
+            c = buf[pos]
+            if expected == _OPEN and c == "[":
+                expected = _FIRST
+                pos += 1
+                continue
+            if expected in (_FIRST, _SEPARATOR) and c == "]":
+                expected = _CLOSED
+                pos += 1
+                continue
+            if expected == _SEPARATOR and c == ",":
+                expected = _VALUE
+                pos += 1
+                continue
+            if expected not in (_FIRST, _VALUE):
+                raise ValueError("invalid JSON array")
+
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            else:
+                if end - pos > max_entry:
+                    raise EntryTooLarge()
+                # a number may continue in the next read
+                if eof or _NUMBER_TAIL.match(buf, end).end() < len(buf):
+                    expected = _SEPARATOR
+                    pos = end
+                    yield obj
+                    continue
+
+            if len(buf) - pos > max_entry:
+                raise EntryTooLarge()
+
+        if eof:
+            if expected != _CLOSED:
+                raise ValueError("invalid JSON array")
+            return
+
+        chunk = stream.read(max(CHUNK_SIZE, len(buf) - pos))
+        eof = not chunk
+        buf = buf[pos:] + text.decode(chunk, final=eof)
+        pos = 0
+
+
+def _bulk_entries(stream, ndjson, max_entry):
+    entries = _ndjson_entries(stream, max_entry) if ndjson \
+        else _json_array_entries(stream, max_entry)
+    for e in entries:
+        if isinstance(e, dict):
+            yield e.get("chip_id"), e.get("config")
+        else:
+            yield None, None
+
+
+def _spool(entries):
+    """Copy entries into an anonymous temporary file, one JSON per line"""
+    spool = tempfile.TemporaryFile()
     try:
-        j = json.loads(local_conf)
-    except json.JSONDecodeError:
-        j = {'config_version': 0}
+        for chip_id, config in entries:
+            spool.write(json.dumps([chip_id, config]).encode("utf-8"))
+            spool.write(b"\n")
+        spool.seek(0)
+    except BaseException:
+        spool.close()
+        raise
+    return spool
 
-    if "config_version" not in j.keys():
-        j = {'config_version': 0}
 
-    new_config = request.get_json()
-    if not isinstance(new_config, dict):
-        return {'local_config': 'invalid config'}, status.HTTP_400_BAD_REQUEST
-    new_config["config_version"] = int(j["config_version"]) + 1
+def _spooled_entries(spool):
+    for line in spool:
+        yield tuple(json.loads(line))
+
+
+@bp.route('/local_config/bulk', methods=['PUT'])
+def deploy_local_config_bulk():
+    if not authorized("w"):
+        return {'deploy': 'not authorized'}, status.HTTP_401_UNAUTHORIZED
+
+    # the body is received and checked before the write transaction starts,
+    # so a slow client does not hold the database lock
+    ndjson = request.mimetype in ("application/x-ndjson",
+                                  "application/jsonl")
+    try:
+        spool = _spool(_bulk_entries(
+            request.stream, ndjson,
+            current_app.config["LOCAL_CONFIG_BULK_MAX_ENTRY"]))
+    except EntryTooLarge:
+        return {'local_config': 'config too large'}, \
+            status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    except (ValueError, UnicodeDecodeError):
+        return {'local_config': 'invalid request body'}, \
+            status.HTTP_400_BAD_REQUEST
+    except OSError as e:
+        print(e)
+        return {'local_config': 'failed to receive configs'}, \
+            status.HTTP_500_INTERNAL_SERVER_ERROR
 
     try:
-        with open(config_file, "w") as f:
-            json.dump(new_config, f, indent=4)
-    except OSError as eos:
-        print(eos)
+        with spool:
+            results = store_local_configs(
+                _spooled_entries(spool),
+                current_app.config["LOCAL_CONFIG_BULK_BATCH"])
+    except sqlite3.Error as e:
+        print(e)
         return {'local_config': 'failed to write config'}, \
             status.HTTP_500_INTERNAL_SERVER_ERROR
 
-    return {'local_config': 'successfully deployed'}, status.HTTP_201_CREATED
+    return {'local_config': results}, status.HTTP_200_OK
 
 
 @bp.route('/global_config', methods=['PUT'])
 def deploy_global_config():
-    token = request.headers.get("X-auth-token")
-    if not verify(token, access="w"):
+    if not authorized("w"):
         return {'deploy': 'not authorized'}, status.HTTP_401_UNAUTHORIZED
 
     key = request.headers.get("X-global-config-key")
@@ -172,38 +631,50 @@ def deploy_global_config():
     if len(key) != 32:
         return {'global_config': 'invalid key'}, status.HTTP_403_FORBIDDEN
 
-    global_conf = None
-    config_file = os.path.join(current_app.instance_path, "global_config.enc")
-    try:
-        with open(config_file, "rb") as f:
-            global_conf = f.read()
-    except OSError:
-        pass
-
-    box = nacl.secret.SecretBox(key)
-    if global_conf:
-        global_conf = box.decrypt(global_conf)
-    else:
-        global_conf = b"{'global_config_version': 0}"
-
-    j = None
-    try:
-        j = json.loads(global_conf.decode("utf-8"))
-    except json.JSONDecodeError:
-        j = {'global_config_version': 0}
-
     new_config = request.get_json()
     if not isinstance(new_config, dict):
         return {'global_config': 'invalid config'}, status.HTTP_400_BAD_REQUEST
-    new_config["global_config_version"] = int(j["global_config_version"]) + 1
 
-    try:
-        with open(config_file, "wb") as f:
+    config_file = os.path.join(current_app.instance_path, "global_config.enc")
+    with deploy_lock():
+        global_conf = None
+        try:
+            with open(config_file, "rb") as f:
+                global_conf = f.read()
+        except OSError:
+            pass
+
+        box = nacl.secret.SecretBox(key)
+        if global_conf:
+            global_conf = box.decrypt(global_conf)
+        else:
+            global_conf = b"{'global_config_version': 0}"
+
+        j = None
+        try:
+            j = json.loads(global_conf.decode("utf-8"))
+        except json.JSONDecodeError:
+            j = {'global_config_version': 0}
+
+        new_config["global_config_version"] = \
+            int(j["global_config_version"]) + 1
+
+        try:
             plaintext = json.dumps(new_config, indent=4).encode("utf-8")
-            f.write(box.encrypt(plaintext))
-    except OSError as eos:
-        print(eos)
-        return {'global_config': 'failed to write config'},\
-            status.HTTP_500_INTERNAL_SERVER_ERROR
-
+            ctext = box.encrypt(plaintext)
+            write_atomic(config_file, ctext)
+            # like the ETag written after the payload it describes
+            meta = {
+                "global_config_version": new_config["global_config_version"],
+                "digest": digest(ctext),
+                "size": len(plaintext),
+            }
+            write_atomic(meta_file(config_file),
+                         json.dumps(meta).encode("utf-8"))
+        except OSError as eos:
+            print(eos)
+            return {'global_config': 'failed to write config'},\
+                status.HTTP_500_INTERNAL_SERVER_ERROR
+
+    notify(GLOBAL_CONFIG_TOPIC)
     return {'global_config': 'successfully deployed'}, status.HTTP_201_CREATED
@@ -0,0 +1,41 @@
+#
+# (C) Copyright 2021 Tillmann Heidsieck
+#
+# SPDX-License-Identifier: MIT
+#
+"""Crash safe file replacement
+
+New files are written to a temporary file in the directory of their final
+path, flushed to the disk and only then renamed into place. Readers that
+opened the old file keep reading it, everyone else gets the new one, and
+neither readers nor a crash ever leave a partial file behind under the
+final name.
+"""
+import os
+import tempfile
+
+
+def temp_file(directory, suffix=".part"):
+    """Open a new temporary file in `directory` for writing"""
+    os.makedirs(directory, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=directory, suffix=suffix)
+    return os.fdopen(fd, "wb"), path
+
+
+def sync(f):
+    """Flush a file written by temp_file() down to the disk"""
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def write_atomic(path, data):
+    """Replace the file at `path` by a complete new snapshot"""
+    f, tmp = temp_file(os.path.dirname(path))
+    try:
+        with f:
+            f.write(data)
+            sync(f)
+        os.replace(tmp, path)
+    except OSError:
+        os.unlink(tmp)
+        raise
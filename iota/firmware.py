@@ -0,0 +1,536 @@
+#
+# (C) Copyright 2021 Tillmann Heidsieck
+#
+# SPDX-License-Identifier: MIT
+#
+"""Firmware catalog
+
+Firmware images are stored content-addressed in the `firmware` directory of
+the instance and registered in the `firmware` table per hardware model and
+release channel. Within a (model, channel) pair versions may only increase,
+so the newest image is the one with the highest id.
+
+If the optional bsdiff4 package is installed, binary patches from the last
+FIRMWARE_DELTA_DEPTH images to each new image are computed on deploy.
+
+An image may be rolled out in stages, e.g. to 1%, 10%, 50% and then 100% of
+the devices. Whether a device is part of a stage follows from a hash of its
+chip ID salted with the image digest, devices outside of the current stage
+are served the preceding image. Stages advance through the deploy API or,
+if an interval is set, every interval seconds.
+"""
+import binascii
+import click
+import collections
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+
+from flask import current_app
+from flask.cli import with_appcontext
+
+from iota.db import get_db
+from iota.files import sync, temp_file, write_atomic
+from iota.notify import firmware_topic, notify
+from iota.version import vercmp, verkey
+
+try:
+    import bsdiff4
+except ImportError:
+    bsdiff4 = None
+
+DELTA_FORMAT = "bsdiff4"
+
+CHUNK_SIZE = 64 * 1024
+
+_B64_INVALID = re.compile(rb"[^A-Za-z0-9+/=]")
+
+Delta = collections.namedtuple("Delta", ["source", "file", "size", "digest"])
+
+Manifest = collections.namedtuple(
+    "Manifest", ["id", "model", "channel", "version", "key", "file", "size",
+                 "digest", "gzip_size", "rollout"])
+
+Rollout = collections.namedtuple(
+    "Rollout", ["stages", "stage", "interval", "started"])
+
+
+def firmware_dir():
+    return os.path.join(current_app.instance_path, "firmware")
+
+
+def _manifest(r):
+    rollout = None
+    if r["rollout_stages"]:
+        rollout = Rollout(tuple(float(p) for p in
+                                r["rollout_stages"].split(",")),
+                          r["rollout_stage"], r["rollout_interval"],
+                          r["rollout_started"])
+    return Manifest(r["id"], r["model"], r["channel"], r["version"],
+                    verkey(r["version"]),
+                    os.path.join(firmware_dir(), r["file"]),
+                    r["size"], r["digest"], r["gzip_size"], rollout)
+
+
+def parse_rollout(stages, interval=None):
+    """Parse a rollout plan like "1,10,50,100" and an interval in seconds
+
+    The percentages have to increase and end at 100. Raises ValueError.
+    """
+    percents = tuple(float(p) for p in stages.split(","))
+    if percents[-1] != 100 or percents[0] <= 0 or \
+            any(a >= b for a, b in zip(percents, percents[1:])):
+        raise ValueError("invalid rollout stages %s" % (stages))
+
+    interval = int(interval) if interval else None
+    if interval is not None and interval <= 0:
+        raise ValueError("invalid rollout interval %s" % (interval))
+    return percents, interval
+
+
+def rollout_stage(manifest, now=None):
+    """Index of the current rollout stage, None if not rolled out in stages"""
+    r = manifest.rollout
+    if r is None:
+        return None
+
+    stage = r.stage
+    if r.interval:
+        now = time.time() if now is None else now
+        stage += max(0, int((now - r.started) // r.interval))
+    return min(stage, len(r.stages) - 1)
+
+
+def rollout_percent(manifest, now=None):
+    stage = rollout_stage(manifest, now)
+    return 100 if stage is None else manifest.rollout.stages[stage]
+
+
+def eligible(manifest, chip_id, now=None):
+    """Whether the current rollout stage of an image includes a device"""
+    percent = rollout_percent(manifest, now)
+    if percent >= 100:
+        return True
+    if not chip_id:
+        return False
+
+    # salted per image, so it is not always the same devices that go first
+    h = hashlib.blake2b(chip_id.encode("utf-8"), digest_size=8,
+                        key=bytes.fromhex(manifest.digest))
+    return int.from_bytes(h.digest(), "big") % 10000 < percent * 100
+
+
+def query_newest(model, channel):
+    """Fetch the newest catalog entry of a model and channel from the DB"""
+    r = get_db().execute("SELECT * FROM firmware \
+                         WHERE model = ? AND channel = ? \
+                         ORDER BY id DESC LIMIT 1",
+                         (model, channel,)).fetchone()
+    return _manifest(r) if r else None
+
+
+def query_releases(model, channel):
+    """Fetch the catalog entries a device of model and channel may be served
+
+    Newest first, down to the newest image that is rolled out completely.
+    """
+    releases = []
+    for r in get_db().execute("SELECT * FROM firmware \
+                              WHERE model = ? AND channel = ? \
+                              ORDER BY id DESC", (model, channel,)):
+        releases.append(_manifest(r))
+        if rollout_percent(releases[-1]) >= 100:
+            break
+    return tuple(releases)
+
+
+class FirmwareCatalog:
+    """In-memory cache of the current releases per model and channel
+
+    The cache is cleared after each deploy. Deploys of other processes are
+    picked up by comparing the mtime of the database, at most once every
+    `check_interval` seconds, so that most firmware polls are answered
+    without touching the file system.
+    """
+    def __init__(self, database, check_interval=1.0):
+        self.database = database
+        self.check_interval = check_interval
+        self._entries = {}
+        self._generation = 0
+        self._stat = None
+        self._next_check = 0
+        self._lock = threading.Lock()
+
+    def _check(self):
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+
+        with self._lock:
+            try:
+                st = os.stat(self.database)
+                stat = (st.st_mtime_ns, st.st_size, st.st_ino)
+            except OSError:
+                stat = None
+            if stat != self._stat:
+                self._stat = stat
+                self._entries.clear()
+                self._generation += 1
+            self._next_check = now + self.check_interval
+
+    def releases(self, model, channel):
+        self._check()
+        try:
+            return self._entries[(model, channel)]
+        except KeyError:
+            pass
+
+        generation = self._generation
+        releases = query_releases(model, channel)
+        with self._lock:
+            if generation == self._generation:
+                self._entries[(model, channel)] = releases
+        return releases
+
+    def newest(self, model, channel):
+        releases = self.releases(model, channel)
+        return releases[0] if releases else None
+
+    def release_for(self, model, channel, chip_id):
+        """Newest image whose rollout includes the device, or None"""
+        now = time.time()
+        for manifest in self.releases(model, channel):
+            if eligible(manifest, chip_id, now):
+                return manifest
+        return None
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+
+def get_firmware_catalog():
+    return current_app.extensions["iota_firmware_catalog"]
+
+
+def newest_firmware(model, channel):
+    return get_firmware_catalog().newest(model, channel)
+
+
+def firmware_for(model, channel, chip_id):
+    return get_firmware_catalog().release_for(model, channel, chip_id)
+
+
+def _make_deltas(manifest):
+    """Compute patches from the preceding images to `manifest`
+
+    bsdiff4 works on whole images in memory. Patches that are not smaller
+    than the image itself are dropped.
+    """
+    depth = current_app.config["FIRMWARE_DELTA_DEPTH"]
+    if bsdiff4 is None or depth <= 0:
+        return 0
+
+    db = get_db()
+    sources = db.execute("SELECT id, file, digest FROM firmware \
+                         WHERE model = ? AND channel = ? AND id < ? \
+                         ORDER BY id DESC LIMIT ?",
+                         (manifest.model, manifest.channel, manifest.id,
+                          depth,)).fetchall()
+    if not sources:
+        return 0
+
+    with open(manifest.file, "rb") as f:
+        data = f.read()
+
+    count = 0
+    for r in sources:
+        try:
+            with open(os.path.join(firmware_dir(), r["file"]), "rb") as f:
+                patch = bsdiff4.diff(f.read(), data)
+        except OSError as e:
+            print(e)
+            continue
+
+        if len(patch) >= len(data):
+            continue
+
+        name = "%s-%s.%s" % (r["digest"], manifest.digest, DELTA_FORMAT)
+        write_atomic(os.path.join(firmware_dir(), name), patch)
+        db.execute("INSERT OR REPLACE INTO firmware_delta \
+                   (source_id, target_id, file, size, digest) \
+                   VALUES (?, ?, ?, ?, ?)",
+                   (r["id"], manifest.id, name, len(patch),
+                    hashlib.sha256(patch).hexdigest(),))
+        count += 1
+
+    db.commit()
+    return count
+
+
+def find_delta(manifest, version):
+    """Patch from the image `version` of the same model and channel"""
+    r = get_db().execute("SELECT d.file, d.size, d.digest FROM firmware f \
+                         JOIN firmware_delta d ON d.source_id = f.id \
+                         WHERE f.model = ? AND f.channel = ? \
+                         AND f.version = ? AND d.target_id = ?",
+                         (manifest.model, manifest.channel, version,
+                          manifest.id,)).fetchone()
+    if not r:
+        return None
+
+    return Delta(version, os.path.join(firmware_dir(), r["file"]), r["size"],
+                 r["digest"])
+
+
+def _temp_file():
+    return temp_file(firmware_dir())
+
+
+def _b64_chunks(stream):
+    """Decode a base64 stream in bounded chunks
+
+    Like base64.b64decode() characters outside of the base64 alphabet are
+    ignored. Raises binascii.Error on incorrect padding.
+    """
+    rest = b""
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        chunk = rest + _B64_INVALID.sub(b"", chunk)
+        n = len(chunk) - len(chunk) % 4
+        rest = chunk[n:]
+        if n:
+            yield binascii.a2b_base64(chunk[:n])
+
+    if rest:
+        raise binascii.Error("Incorrect padding")
+
+
+def _raw_chunks(stream):
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+
+def store_image(stream, encoded=False):
+    """Copy an image from a stream into a temporary file
+
+    The image is written and hashed chunk by chunk, so memory use does not
+    depend on the size of the image. Returns the path, size and SHA-256
+    digest of the temporary file.
+    """
+    sha256 = hashlib.sha256()
+    size = 0
+    f, tmp = _temp_file()
+    try:
+        with f:
+            chunks = _b64_chunks(stream) if encoded else _raw_chunks(stream)
+            for chunk in chunks:
+                sha256.update(chunk)
+                size += len(chunk)
+                f.write(chunk)
+            sync(f)
+    except (OSError, binascii.Error):
+        os.unlink(tmp)
+        raise
+
+    return tmp, size, sha256.hexdigest()
+
+
+def _compress(path):
+    """Store a gzip variant of an image if it actually saves bytes"""
+    f, tmp = _temp_file()
+    try:
+        with f, open(path, "rb") as src:
+            with gzip.GzipFile(filename="", mode="wb", fileobj=f,
+                               compresslevel=9, mtime=0) as gz:
+                shutil.copyfileobj(src, gz, CHUNK_SIZE)
+            sync(f)
+            gzip_size = f.tell()
+    except OSError:
+        os.unlink(tmp)
+        raise
+
+    if gzip_size >= os.path.getsize(path):
+        os.unlink(tmp)
+        return None
+
+    os.replace(tmp, path + ".gz")
+    return gzip_size
+
+
+def _unpublish(name):
+    """Remove an image and its variants unless the catalog refers to them"""
+    if get_db().execute("SELECT 1 FROM firmware WHERE file = ?",
+                        (name,)).fetchone():
+        return
+
+    for f in (name, name + ".gz"):
+        try:
+            os.unlink(os.path.join(firmware_dir(), f))
+        except FileNotFoundError:
+            pass
+
+
+class VersionConflict(Exception):
+    """Raised when a published image is not newer than the current one"""
+
+
+def publish_image(model, channel, version, tmp, size, digest, rollout=None):
+    """Move a stored image into place and register it in the catalog
+
+    Images are immutable and named by their digest. They and their variants
+    are renamed into place before the catalog row is committed, so readers
+    either see the previous image or the complete new one. The version check
+    and the insert run in one write transaction, which serializes parallel
+    deploys of the same model and channel.
+
+    `rollout` is a (stages, interval) pair of parse_rollout() or None to
+    serve the image to all devices at once.
+    """
+    stages, interval = rollout or (None, None)
+    started = time.time()
+    # checked again below, this only saves renaming and compressing
+    current = query_newest(model, channel)
+    if current and vercmp(current.version, version) <= 0:
+        raise VersionConflict(current.version)
+
+    name = digest + ".sig"
+    path = os.path.join(firmware_dir(), name)
+    existed = os.path.exists(path)
+    os.replace(tmp, path)
+
+    db = get_db()
+    try:
+        gzip_size = _compress(path)
+        db.execute("BEGIN IMMEDIATE")
+        current = query_newest(model, channel)
+        if current and vercmp(current.version, version) <= 0:
+            raise VersionConflict(current.version)
+        cur = db.execute("INSERT INTO firmware \
+                         (model, channel, version, file, size, digest, \
+                         gzip_size, rollout_stages, rollout_interval, \
+                         rollout_started) \
+                         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         (model, channel, version, name, size, digest,
+                          gzip_size,
+                          ",".join("%g" % p for p in stages)
+                          if stages else None,
+                          interval, started,))
+        db.commit()
+    except (OSError, sqlite3.Error, VersionConflict):
+        db.rollback()
+        if not existed:
+            _unpublish(name)
+        raise
+    finally:
+        get_firmware_catalog().invalidate()
+    notify(firmware_topic(model, channel))
+
+    manifest = Manifest(cur.lastrowid, model, channel, version,
+                        verkey(version), path, size, digest, gzip_size,
+                        Rollout(stages, 0, interval, started)
+                        if stages else None)
+    try:
+        deltas = _make_deltas(manifest)
+    except (OSError, sqlite3.Error) as e:
+        print(e)
+        deltas = 0
+
+    return manifest, deltas
+
+
+def add_firmware(model, channel, version, stream, encoded=False,
+                 rollout=None):
+    """Store an image and register it as the newest of model and channel"""
+    tmp, size, digest = store_image(stream, encoded)
+    try:
+        return publish_image(model, channel, version, tmp, size, digest,
+                             rollout)
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+
+
+def advance_rollout(model, channel, version, stage=None):
+    """Move the rollout of an image to `stage`, by default the next one
+
+    Scheduled rollouts continue from the new stage. Returns the updated
+    manifest, raises KeyError for unknown images and ValueError for stages
+    out of range.
+    """
+    db = get_db()
+    try:
+        db.execute("BEGIN IMMEDIATE")
+        r = db.execute("SELECT * FROM firmware WHERE model = ? AND \
+                       channel = ? AND version = ?",
+                       (model, channel, version,)).fetchone()
+        if not r:
+            raise KeyError(version)
+
+        manifest = _manifest(r)
+        if manifest.rollout is None:
+            db.rollback()
+            return manifest
+
+        if stage is None:
+            stage = min(rollout_stage(manifest) + 1,
+                        len(manifest.rollout.stages) - 1)
+        if not 0 <= stage < len(manifest.rollout.stages):
+            raise ValueError("invalid rollout stage %s" % (stage))
+
+        rollout = manifest.rollout._replace(stage=stage, started=time.time())
+        db.execute("UPDATE firmware SET rollout_stage = ?, \
+                   rollout_started = ? WHERE id = ?",
+                   (rollout.stage, rollout.started, manifest.id,))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        get_firmware_catalog().invalidate()
+
+    notify(firmware_topic(model, channel))
+    return manifest._replace(rollout=rollout)
+
+
+@click.command('import-firmware')
+@with_appcontext
+def import_firmware_command():
+    """Add the image of a legacy firmware.json to the catalog."""
+    config_file = os.path.join(current_app.instance_path, "firmware.json")
+    try:
+        with open(config_file, "rb") as f:
+            j = json.load(f)
+        image = os.path.join(current_app.instance_path, j["file"])
+        version = j["version"]
+    except (OSError, KeyError, json.JSONDecodeError) as e:
+        raise click.ClickException("failed to load %s: %s" % (config_file, e))
+
+    model = current_app.config["FIRMWARE_DEFAULT_MODEL"]
+    channel = current_app.config["FIRMWARE_DEFAULT_CHANNEL"]
+    try:
+        with open(image, "rb") as f:
+            add_firmware(model, channel, version, f)
+    except VersionConflict as e:
+        raise click.ClickException("catalog already has version %s" % (e))
+    except (OSError, sqlite3.Error) as e:
+        raise click.ClickException(str(e))
+    click.echo('Imported firmware %s for %s/%s.' % (version, model, channel))
+
+
+def init_app(app):
+    app.extensions["iota_firmware_catalog"] = FirmwareCatalog(
+        app.config["DATABASE"], app.config["FIRMWARE_CATALOG_CHECK_INTERVAL"])
+    app.cli.add_command(import_firmware_command)
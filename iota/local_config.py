@@ -0,0 +1,165 @@
+#
+# (C) Copyright 2021 Tillmann Heidsieck
+#
+# SPDX-License-Identifier: MIT
+#
+"""Per-device configuration store
+
+Local configs are kept in the `local_configs` table, one row per chip ID
+with the config version, the JSON payload and its digest. Polls only need
+the version and digest, the payload is read when a device is behind.
+"""
+import click
+import hashlib
+import json
+import os
+import sqlite3
+
+from flask import current_app
+from flask.cli import with_appcontext
+
+from iota.db import get_db
+from iota.notify import local_config_topic, notify
+
+_CONFIG_PREFIX = "config.json."
+
+
+def local_config_meta(chip_id):
+    """Return the (config_version, digest, size) row of a chip or None"""
+    return get_db().execute("SELECT config_version, digest, \
+                            length(payload) AS size \
+                            FROM local_configs WHERE chip_id = ?",
+                            (chip_id,)).fetchone()
+
+
+def local_config_payload(chip_id):
+    r = get_db().execute("SELECT payload FROM local_configs \
+                         WHERE chip_id = ?", (chip_id,)).fetchone()
+    return r["payload"] if r else None
+
+
+_STORE = "INSERT OR REPLACE INTO local_configs \
+          (chip_id, config_version, payload, digest) VALUES (?, ?, ?, ?)"
+
+
+def _row(chip_id, config):
+    payload = json.dumps(config, indent=4).encode("utf-8")
+    return (chip_id, config["config_version"], payload,
+            hashlib.sha256(payload).hexdigest())
+
+
+def _store(db, chip_id, config):
+    db.execute(_STORE, _row(chip_id, config))
+
+
+def store_local_config(chip_id, config):
+    """Store a new config for a chip and bump its config_version
+
+    The read of the old version and the write happen in one write
+    transaction, so concurrent deploys for a chip never lose a version.
+    """
+    db = get_db()
+    try:
+        db.execute("BEGIN IMMEDIATE")
+        r = local_config_meta(chip_id)
+        config["config_version"] = (r["config_version"] if r else 0) + 1
+        _store(db, chip_id, config)
+        db.commit()
+    except sqlite3.Error:
+        db.rollback()
+        raise
+
+    notify(local_config_topic(chip_id))
+    return config["config_version"]
+
+
+def _batches(entries, size):
+    batch = []
+    for entry in entries:
+        batch.append(entry)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def store_local_configs(entries, batch_size=500):
+    """Store many (chip_id, config) pairs in a single write transaction
+
+    Entries are consumed lazily and written in batches of `batch_size`, one
+    query fetches the current versions of a whole batch. Entries without a
+    chip ID or with a config that is not an object are reported, not
+    stored. Any exception raised while consuming `entries` rolls back the
+    whole transaction. Returns one result per entry.
+    """
+    db = get_db()
+    results = []
+    try:
+        db.execute("BEGIN IMMEDIATE")
+        for batch in _batches(entries, batch_size):
+            chip_ids = list({c for c, config in batch
+                             if isinstance(c, str) and c})
+            versions = {}
+            if chip_ids:
+                for r in db.execute("SELECT chip_id, config_version \
+                                    FROM local_configs WHERE chip_id IN (%s)"
+                                    % ",".join("?" * len(chip_ids)),
+                                    chip_ids).fetchall():
+                    versions[r["chip_id"]] = r["config_version"]
+
+            rows = []
+            for chip_id, config in batch:
+                if not isinstance(chip_id, str) or not chip_id or \
+                        not isinstance(config, dict):
+                    results.append({"chip_id": chip_id,
+                                    "local_config": "invalid config"})
+                    continue
+                versions[chip_id] = versions.get(chip_id, 0) + 1
+                config["config_version"] = versions[chip_id]
+                rows.append(_row(chip_id, config))
+                results.append({"chip_id": chip_id,
+                                "config_version": versions[chip_id]})
+            db.executemany(_STORE, rows)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    notify(*{local_config_topic(r["chip_id"]) for r in results
+             if "config_version" in r})
+    return results
+
+
+@click.command('import-local-configs')
+@with_appcontext
+def import_local_configs_command():
+    """Import config.json.<chip id> files of the instance folder."""
+    db = get_db()
+    count = 0
+    for name in sorted(os.listdir(current_app.instance_path)):
+        chip_id = name[len(_CONFIG_PREFIX):]
+        if not name.startswith(_CONFIG_PREFIX) or "." in chip_id:
+            continue
+        if local_config_meta(chip_id):
+            click.echo('Skipping %s: already imported' % (name))
+            continue
+
+        try:
+            with open(os.path.join(current_app.instance_path, name),
+                      "rb") as f:
+                config = json.load(f)
+            config["config_version"] = int(config.get("config_version", 0))
+        except (OSError, ValueError, AttributeError) as e:
+            click.echo('Skipping %s: %s' % (name, e))
+            continue
+
+        _store(db, chip_id, config)
+        count += 1
+
+    db.commit()
+    click.echo('Imported %d local configs.' % (count))
+
+
+def init_app(app):
+    app.cli.add_command(import_local_configs_command)
@@ -0,0 +1,107 @@
+#
+# (C) Copyright 2021 Tillmann Heidsieck
+#
+# SPDX-License-Identifier: MIT
+#
+"""In-process deploy notifications
+
+Every deploy bumps the generation of the topics it affects. Long-polling
+devices remember the generations of their topics and wait until one of
+them changes. Threads wait on a condition variable, asyncio tasks on a
+future that is resolved on their own loop.
+
+Only deploys of this process are seen, waiters of other processes notice
+them when their wait times out.
+"""
+import asyncio
+import collections
+import threading
+
+from flask import current_app
+
+
+def firmware_topic(model, channel):
+    return ("firmware", model, channel)
+
+
+def local_config_topic(chip_id):
+    return ("local_config", chip_id)
+
+
+GLOBAL_CONFIG_TOPIC = ("global_config",)
+
+
+def _resolve(fut):
+    if not fut.done():
+        fut.set_result(None)
+
+
+class NotificationHub:
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._generations = collections.Counter()
+        self._futures = collections.defaultdict(set)
+
+    def generations(self, topics):
+        with self._cond:
+            return {t: self._generations[t] for t in topics}
+
+    def _changed(self, since):
+        return any(self._generations[t] != g for t, g in since.items())
+
+    def signal(self, *topics):
+        futures = set()
+        with self._cond:
+            for t in topics:
+                self._generations[t] += 1
+                futures |= self._futures.get(t, set())
+            self._cond.notify_all()
+
+        for loop, fut in futures:
+            try:
+                loop.call_soon_threadsafe(_resolve, fut)
+            except RuntimeError:
+                # the loop of the waiter is already closed
+                pass
+
+    def wait(self, since, timeout):
+        """Block until a topic in `since` moved past its generation
+
+        Returns False if `timeout` seconds passed without a change.
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: self._changed(since), timeout)
+
+    async def wait_async(self, since, timeout):
+        """Like wait(), but without blocking the running event loop"""
+        loop = asyncio.get_running_loop()
+        waiter = (loop, loop.create_future())
+        with self._cond:
+            if self._changed(since):
+                return True
+            for t in since:
+                self._futures[t].add(waiter)
+
+        try:
+            await asyncio.wait_for(waiter[1], timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self._cond:
+                for t in since:
+                    self._futures[t].discard(waiter)
+                    if not self._futures[t]:
+                        del self._futures[t]
+
+
+def get_hub():
+    return current_app.extensions["iota_notify"]
+
+
+def notify(*topics):
+    get_hub().signal(*topics)
+
+
+def init_app(app):
+    app.extensions["iota_notify"] = NotificationHub()
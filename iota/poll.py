@@ -0,0 +1,86 @@
+#
+# (C) Copyright 2021 Tillmann Heidsieck
+#
+# SPDX-License-Identifier: MIT
+#
+"""Poll interval hints
+
+Every device-facing response carries an X-poll-interval header with the
+number of seconds the device should wait before its next poll. The delay is
+computed by the POLL_POLICY callable from a PollContext, so policies can be
+tried without a server. POLL_POLICY may also name a policy as an import
+string like "mymodule:policy".
+"""
+import collections
+import hashlib
+import math
+import threading
+import time
+
+from werkzeug.utils import import_string
+
+# chip_id may be None, rate is in requests per second, pending tells whether
+# an update waits for the device, the rest are the POLL_* settings
+PollContext = collections.namedtuple(
+    "PollContext", ["chip_id", "now", "rate", "pending", "interval",
+                    "min_interval", "target_rate"])
+
+
+class RequestRate:
+    """Exponentially decaying requests per second estimate"""
+    def __init__(self, halflife=10.0):
+        self.halflife = halflife
+        self._count = 0.0
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _decay(self, now):
+        self._count *= 0.5 ** ((now - self._stamp) / self.halflife)
+        self._stamp = now
+
+    def hit(self):
+        with self._lock:
+            self._decay(time.monotonic())
+            self._count += 1
+
+    def rate(self):
+        with self._lock:
+            self._decay(time.monotonic())
+            # the sum of a decaying unit rate over time is halflife / ln 2
+            return self._count * math.log(2) / self.halflife
+
+
+def chip_phase(chip_id):
+    """Stable position of a device within the poll interval, in [0, 1)"""
+    h = hashlib.blake2b(chip_id.encode("utf-8"), digest_size=8)
+    return int.from_bytes(h.digest(), "big") / 2 ** 64
+
+
+def default_poll_policy(ctx):
+    """Spread the fleet evenly over the interval, hurry if an update waits
+
+    The interval is stretched while the server sees more than the target
+    rate. Each device is sent to its own slot within the interval, derived
+    from its chip ID, so devices that polled together drift apart.
+    """
+    if ctx.pending:
+        return ctx.min_interval
+
+    interval = max(ctx.interval, ctx.min_interval, 1)
+    if ctx.target_rate and ctx.rate > ctx.target_rate:
+        interval *= ctx.rate / ctx.target_rate
+    if not ctx.chip_id:
+        return math.ceil(interval)
+
+    delay = (chip_phase(ctx.chip_id) * interval - ctx.now) % interval
+    if delay < ctx.min_interval:
+        delay += interval
+    return math.ceil(delay)
+
+
+def load_poll_policy(policy):
+    if policy is None:
+        return default_poll_policy
+    if isinstance(policy, str):
+        return import_string(policy)
+    return policy
@@ -7,6 +7,9 @@
 
 DROP TABLE IF EXISTS versions;
 DROP TABLE IF EXISTS tokens;
+DROP TABLE IF EXISTS firmware;
+DROP TABLE IF EXISTS firmware_delta;
+DROP TABLE IF EXISTS local_configs;
 
 CREATE TABLE versions (
 	id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
@@ -18,9 +21,48 @@ CREATE TABLE tokens (
 	id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
 	name VARCHAR(512) NOT NULL,
 	token VARCHAR(512) NOT NULL,
-	permissions VARCHAR(16)
+	lookup VARCHAR(32),
+	permissions VARCHAR(16),
+	perm_flags INTEGER NOT NULL DEFAULT 0
 );
 CREATE UNIQUE INDEX unique_token_name ON tokens (name);
 CREATE INDEX token ON tokens (token);
+CREATE UNIQUE INDEX unique_token_lookup ON tokens (lookup);
+CREATE INDEX token_perm_flags ON tokens (perm_flags);
 
-INSERT INTO tokens (name, token, permissions) VALUES ("admin", "$argon2id$v=19$m=65536,t=2,p=1$bUIXjfewRvbW7B1aEd+Mxw$Q3aeaari5GqwojBAlqVf0X0IyFcGzwrBPFqds5lmnWk", "arw");
+CREATE TABLE firmware (
+	id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+	model VARCHAR(64) NOT NULL,
+	channel VARCHAR(64) NOT NULL,
+	version VARCHAR(128) NOT NULL,
+	file VARCHAR(512) NOT NULL,
+	size INTEGER NOT NULL,
+	digest VARCHAR(64) NOT NULL,
+	gzip_size INTEGER,
+	rollout_stages VARCHAR(256),
+	rollout_stage INTEGER NOT NULL DEFAULT 0,
+	rollout_interval INTEGER,
+	rollout_started REAL,
+	created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE UNIQUE INDEX unique_firmware_version ON firmware (model, channel, version);
+CREATE INDEX firmware_newest ON firmware (model, channel, id);
+
+CREATE TABLE firmware_delta (
+	source_id INTEGER NOT NULL REFERENCES firmware (id),
+	target_id INTEGER NOT NULL REFERENCES firmware (id),
+	file VARCHAR(512) NOT NULL,
+	size INTEGER NOT NULL,
+	digest VARCHAR(64) NOT NULL,
+	PRIMARY KEY (target_id, source_id)
+);
+
+CREATE TABLE local_configs (
+	chip_id VARCHAR(64) PRIMARY KEY NOT NULL,
+	config_version INTEGER NOT NULL,
+	payload BLOB NOT NULL,
+	digest VARCHAR(64) NOT NULL
+);
+CREATE INDEX local_config_version ON local_configs (config_version);
+
+INSERT INTO tokens (name, token, lookup, permissions, perm_flags) VALUES ("admin", "$argon2id$v=19$m=65536,t=2,p=1$bUIXjfewRvbW7B1aEd+Mxw$Q3aeaari5GqwojBAlqVf0X0IyFcGzwrBPFqds5lmnWk", "87c4e760e760972f3bc04b702257f2c3", "arw", 7);
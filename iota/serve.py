@@ -9,21 +9,279 @@
 from flask import (
     Blueprint,
     current_app,
+    g,
     json,
     request,
+    send_file,
 )
 from flask_api import status
 
 import base64
+import collections
+import hashlib
+import math
+import nacl.exceptions
 import nacl.secret
 import nacl.utils
 import os
+import random
+import threading
+import time
 
-from .deploy import vercmp
+from .deploy import firmware_target, meta_file
+from .firmware import DELTA_FORMAT, find_delta, firmware_for
+from .local_config import local_config_meta, local_config_payload
+from .notify import (
+    GLOBAL_CONFIG_TOPIC,
+    firmware_topic,
+    get_hub,
+    local_config_topic,
+)
+from .poll import PollContext, RequestRate, load_poll_policy
+from .token import authorized
+from .version import keycmp, verkey
 
 bp = Blueprint('serve', __name__, url_prefix='/api/v1')
 
 
+def _etag_matches(etag):
+    return etag is not None and request.if_none_match.contains(etag)
+
+
+def _not_modified(etag):
+    return {}, status.HTTP_304_NOT_MODIFIED, {"ETag": '"%s"' % etag}
+
+
+class GlobalConfigCache:
+    """Version sidecar and decrypted payloads of global_config.enc
+
+    The sidecar written on deploy is re-read whenever its mtime changes.
+    Decrypted and parsed payloads are kept in a bounded LRU cache keyed by
+    the state of the ciphertext file and a digest of the key.
+    """
+    def __init__(self, instance_path, maxsize=16):
+        self.path = os.path.join(instance_path, "global_config.enc")
+        self.maxsize = maxsize
+        self._meta = None
+        self._meta_stat = None
+        self._payloads = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _stat(path):
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def meta(self):
+        try:
+            stat = self._stat(meta_file(self.path))
+        except OSError:
+            return None
+
+        with self._lock:
+            if stat != self._meta_stat:
+                try:
+                    with open(meta_file(self.path), "rb") as f:
+                        self._meta = json.load(f)
+                except (OSError, json.JSONDecodeError):
+                    self._meta = None
+                self._meta_stat = stat
+            return self._meta
+
+    def payload(self, key):
+        """Return plaintext and version, raises OSError and CryptoError"""
+        cache_key = (self._stat(self.path), hashlib.blake2b(key).digest())
+        with self._lock:
+            if cache_key in self._payloads:
+                self._payloads.move_to_end(cache_key)
+                return self._payloads[cache_key]
+
+        with open(self.path, "rb") as f:
+            ctext = f.read()
+        plaintext = nacl.secret.SecretBox(key).decrypt(ctext)
+        j = json.loads(plaintext.decode("utf-8"))
+        entry = (plaintext, int(j["global_config_version"]))
+
+        with self._lock:
+            self._payloads[cache_key] = entry
+            while len(self._payloads) > self.maxsize:
+                self._payloads.popitem(last=False)
+        return entry
+
+
+class TransferLimiter:
+    """Admission control for firmware transfers shared by all threads
+
+    Limits the number of concurrent transfers and, with a token bucket
+    holding one second worth of bytes, the rate of transferred bytes.
+    Admitted transfers are charged in full up front, so the bucket may go
+    into debt and then turns away transfers until it is paid off.
+    """
+    def __init__(self, max_transfers=None, rate=None, retry_after=30):
+        self.max_transfers = max_transfers
+        self.rate = rate
+        self.retry_after = retry_after
+        self.active = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.bytes = 0
+        self._tokens = rate or 0
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self._tokens = min(self.rate,
+                               self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def acquire(self, size):
+        """Admit a transfer of `size` bytes
+
+        Returns None if admitted, otherwise the seconds until a retry may
+        succeed, including a random jitter to spread the retries.
+        """
+        with self._lock:
+            self._refill()
+            if self.max_transfers and self.active >= self.max_transfers:
+                wait = 0
+            elif self.rate and self._tokens <= 0:
+                wait = -self._tokens / self.rate
+            else:
+                self.active += 1
+                self.admitted += 1
+                self.bytes += size
+                if self.rate:
+                    self._tokens -= size
+                return None
+            self.rejected += 1
+
+        return wait + random.uniform(0, self.retry_after)
+
+    def release(self):
+        with self._lock:
+            self.active -= 1
+
+    @property
+    def limited(self):
+        return bool(self.max_transfers or self.rate)
+
+    def status(self):
+        with self._lock:
+            self._refill()
+            return {"active": self.active,
+                    "max_transfers": self.max_transfers,
+                    "rate": self.rate,
+                    "tokens": int(self._tokens) if self.rate else None,
+                    "admitted": self.admitted,
+                    "rejected": self.rejected,
+                    "bytes": self.bytes}
+
+
+def init_app(app):
+    app.extensions["iota_global_config"] = GlobalConfigCache(
+        app.instance_path, app.config["GLOBAL_CONFIG_CACHE_SIZE"])
+    app.extensions["iota_transfers"] = TransferLimiter(
+        app.config["FIRMWARE_MAX_TRANSFERS"], app.config["FIRMWARE_MAX_RATE"],
+        app.config["FIRMWARE_RETRY_AFTER"])
+    app.extensions["iota_request_rate"] = RequestRate()
+    app.extensions["iota_poll_policy"] = load_poll_policy(
+        app.config["POLL_POLICY"])
+
+
+@bp.after_request
+def poll_interval(response):
+    """Tell the device when to poll next, see iota.poll"""
+    rate = current_app.extensions["iota_request_rate"]
+    rate.hit()
+    ctx = PollContext(request.headers.get("X-chip-id"), time.time(),
+                      rate.rate(), g.get("poll_pending", False),
+                      current_app.config["POLL_INTERVAL"],
+                      current_app.config["POLL_INTERVAL_MIN"],
+                      current_app.config["POLL_TARGET_RATE"])
+    try:
+        interval = int(current_app.extensions["iota_poll_policy"](ctx))
+    except Exception as e:
+        print(e)
+        interval = ctx.interval
+    response.headers["X-poll-interval"] = str(interval)
+    return response
+
+
+class _ImageFile:
+    """Firmware image handed to the WSGI server
+
+    It has a fileno(), so servers still sendfile() it, and calls `on_close`
+    once the server closes it. File responses are passed through to the
+    server, call_on_close() of the response would never run.
+    """
+    def __init__(self, path):
+        self._f = open(path, "rb")
+        self.on_close = None
+
+    def read(self, size=-1):
+        return self._f.read(size)
+
+    def fileno(self):
+        return self._f.fileno()
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self._f.seek(offset, whence)
+
+    def tell(self):
+        return self._f.tell()
+
+    def close(self):
+        try:
+            self._f.close()
+        finally:
+            on_close, self.on_close = self.on_close, None
+            if on_close:
+                on_close()
+
+
+def _send_image(image, etag):
+    """send_file() of an _ImageFile, answering conditional requests"""
+    try:
+        st = os.fstat(image.fileno())
+        response = send_file(image, mimetype="application/octet-stream",
+                             etag=etag, last_modified=st.st_mtime)
+        response.content_length = st.st_size
+        response.make_conditional(request.environ, accept_ranges=True,
+                                  complete_length=st.st_size)
+    except BaseException:
+        image.close()
+        raise
+
+    if response.status_code == status.HTTP_304_NOT_MODIFIED:
+        # the body is dropped without being closed
+        image.close()
+    return response
+
+
+def _admit(response, image):
+    """Pass a firmware response or turn it into a 503 if over the limits"""
+    limiter = current_app.extensions["iota_transfers"]
+    if not limiter.limited or \
+            response.status_code not in (status.HTTP_200_OK,
+                                         status.HTTP_206_PARTIAL_CONTENT):
+        return response
+
+    wait = limiter.acquire(response.content_length or 0)
+    if wait is None:
+        image.on_close = limiter.release
+        return response
+
+    response.close()
+    return {'firmware': 'too many transfers'}, \
+        status.HTTP_503_SERVICE_UNAVAILABLE, \
+        {"Retry-After": str(max(1, math.ceil(wait)))}
+
+
 @bp.route('/global_config')
 def gconfig():
     version = request.headers.get("X-global-config-version")
@@ -40,30 +298,35 @@ def gconfig():
     if len(key) != 32:
         return {'global_config': 'invalid key'}, status.HTTP_403_FORBIDDEN
 
-    ctext = None
-    config_file = os.path.join(current_app.instance_path, "global_config.enc")
+    # up to date devices are answered from the sidecar without decrypting,
+    # the key is only checked when the config is actually delivered
+    cache = current_app.extensions["iota_global_config"]
+    meta = cache.meta()
+    etag = meta["digest"] if meta else None
+    if _etag_matches(etag):
+        return _not_modified(etag)
+
+    if meta and int(version) >= int(meta["global_config_version"]):
+        return {'global_config': 'no version new version'}, \
+            status.HTTP_404_NOT_FOUND
+
     try:
-        with open(config_file, "rb") as f:
-            ctext = f.read()
+        plaintext, server_version = cache.payload(key)
     except OSError:
         return {'global_config': 'invalid key'}, \
             status.HTTP_503_SERVICE_UNAVAILABLE
-
-    box = nacl.secret.SecretBox(key)
-    plaintext = box.decrypt(ctext)
-
-    j = None
-    try:
-        j = json.loads(plaintext.decode("utf-8"))
-    except json.JSONDecodeError:
+    except nacl.exceptions.CryptoError:
+        return {'global_config': 'invalid key'}, status.HTTP_403_FORBIDDEN
+    except (json.JSONDecodeError, UnicodeDecodeError, KeyError):
         return {'global_config': 'failed to load'}, \
             status.HTTP_403_FORBIDDEN
 
-    if int(version) >= int(j["global_config_version"]):
+    if int(version) >= server_version:
         return {'global_config': 'no version new version'}, \
             status.HTTP_404_NOT_FOUND
 
-    return plaintext, status.HTTP_200_OK
+    headers = {"ETag": '"%s"' % etag} if etag else {}
+    return plaintext, status.HTTP_200_OK, headers
 
 
 @bp.route('/local_config')
@@ -78,27 +341,20 @@ def lconfig():
         return {'local_config': 'no CHIP ID given'}, \
             status.HTTP_404_NOT_FOUND
 
-    local_conf = None
-    config_file = os.path.join(current_app.instance_path,
-                               "config.json.%s" % (chip_id))
-    try:
-        with open(config_file, "rb") as f:
-            local_conf = f.read()
-    except OSError:
+    meta = local_config_meta(chip_id)
+    if not meta:
         return {'local_config': 'config for chip id not found'},\
             status.HTTP_404_NOT_FOUND
 
-    j = None
-    try:
-        j = json.loads(local_conf)
-    except json.JSONDecodeError:
-        return {'local_config': 'failed to load'},\
-            status.HTTP_500_INTERNAL_SERVER_ERROR
-    if int(version) >= int(j["config_version"]):
+    if _etag_matches(meta["digest"]):
+        return _not_modified(meta["digest"])
+
+    if int(version) >= meta["config_version"]:
         return {'local_config': 'no version new version'},\
             status.HTTP_404_NOT_FOUND
 
-    return local_conf, status.HTTP_200_OK
+    return local_config_payload(chip_id), status.HTTP_200_OK, \
+        {"ETag": '"%s"' % meta["digest"]}
 
 
 @bp.route('/firmware')
@@ -107,38 +363,208 @@ def firmware():
     if not version:
         return {'firmware': 'no version given'}, status.HTTP_404_NOT_FOUND
 
-    firmware_json = os.path.join(current_app.instance_path, "firmware.json")
-    try:
-        with open(firmware_json, "rb") as f:
-            j = json.load(f)
-    except OSError:
-        return {}, status.HTTP_404_NOT_FOUND
-    except json.JSONDecodeError:
+    # devices outside of a staged rollout get the image before it
+    manifest = firmware_for(*firmware_target(),
+                            request.headers.get("X-chip-id"))
+    if manifest is None:
         return {}, status.HTTP_404_NOT_FOUND
 
-    if "version" in j.keys():
-        server_version = j["version"]
+    if _etag_matches(manifest.digest):
+        return _not_modified(manifest.digest)
+
+    try:
+        if keycmp(verkey(version), manifest.key) <= 0:
+            return {}, status.HTTP_304_NOT_MODIFIED
+    except (ValueError, TypeError):
+        return {'firmware': 'invalid version'}, status.HTTP_400_BAD_REQUEST
+
+    if manifest.file is None:
+        return {'firmware': "not found"}, status.HTTP_404_NOT_FOUND
+
+    if request.headers.get("X-firmware-delta") == DELTA_FORMAT:
+        delta = find_delta(manifest, version)
+        if delta:
+            image = _ImageFile(delta.file)
+            response = _send_image(image, delta.digest)
+            response.headers["X-firmware-delta"] = DELTA_FORMAT
+            response.headers["X-firmware-delta-source"] = delta.source
+            response.headers["X-firmware-digest"] = manifest.digest
+            return _admit(response, image)
+
+    if manifest.gzip_size and request.accept_encodings["gzip"]:
+        image = _ImageFile(manifest.file + ".gz")
+        response = _send_image(image, manifest.digest + "-gzip")
+        response.headers["Content-Encoding"] = "gzip"
     else:
-        server_version = "0.0"
+        # streamed by the WSGI file wrapper, answers Range requests with 206
+        image = _ImageFile(manifest.file)
+        response = _send_image(image, manifest.digest)
+    response.vary.add("Accept-Encoding")
+    return _admit(response, image)
+
+
+@bp.route('/firmware/transfers')
+def transfers():
+    """Occupancy of the firmware transfer limits of this process"""
+    if not authorized("r"):
+        return {'transfers': 'not authorized'}, status.HTTP_401_UNAUTHORIZED
+
+    return current_app.extensions["iota_transfers"].status(), \
+        status.HTTP_200_OK
+
+
+def _checkin_firmware(chip_id, version):
+    manifest = firmware_for(*firmware_target(), chip_id)
+    if manifest is None:
+        return None
+
+    return {
+        "update": keycmp(verkey(version), manifest.key) > 0,
+        "version": manifest.version,
+        "digest": manifest.digest,
+        "size": manifest.size,
+        "gzip_size": manifest.gzip_size,
+    }
+
+
+def _checkin_local_config(chip_id, version):
+    meta = local_config_meta(chip_id)
+    if not meta:
+        return None
+
+    j = {
+        "update": int(version) < meta["config_version"],
+        "config_version": meta["config_version"],
+        "digest": meta["digest"],
+        "size": meta["size"],
+    }
+    if j["update"] and meta["size"] <= \
+            current_app.config["CHECKIN_INLINE_MAX"]:
+        j["config"] = json.loads(local_config_payload(chip_id))
+    return j
+
+
+def _checkin_global_config(version):
+    meta = current_app.extensions["iota_global_config"].meta()
+    if not meta:
+        return None
+
+    return {
+        "update": int(version) < int(meta["global_config_version"]),
+        "global_config_version": meta["global_config_version"],
+        "digest": meta["digest"],
+        "size": meta.get("size"),
+    }
+
+
+def _checkin_report(chip_id):
+    """Check-in answer for the version headers of the request
 
-    if vercmp(version, server_version) <= 0:
-        return {}, status.HTTP_304_NOT_MODIFIED
+    Raises ValueError or TypeError on malformed versions, the latter when
+    a firmware version cannot be compared to the catalog.
+    """
+    j = {}
+    version = request.headers.get("X-ESP8266-version")
+    if version:
+        j["firmware"] = _checkin_firmware(chip_id, version)
+
+    version = request.headers.get("X-config-version")
+    if version:
+        j["local_config"] = _checkin_local_config(chip_id, version)
+
+    version = request.headers.get("X-global-config-version")
+    if version:
+        j["global_config"] = _checkin_global_config(version)
+    return j
+
+
+def _checkin_topics(chip_id):
+    topics = []
+    if request.headers.get("X-ESP8266-version"):
+        topics.append(firmware_topic(*firmware_target()))
+    if request.headers.get("X-config-version"):
+        topics.append(local_config_topic(chip_id))
+    if request.headers.get("X-global-config-version"):
+        topics.append(GLOBAL_CONFIG_TOPIC)
+    return topics
 
+
+def _pending(j):
+    return any(a and a["update"] for a in j.values())
+
+
+def poll_timeout():
+    """Requested wait of a long poll, capped by LONGPOLL_TIMEOUT"""
+    timeout = current_app.config["LONGPOLL_TIMEOUT"]
     try:
-        ffile = j["file"]
-    except ValueError:
-        return {}, status.HTTP_404_NOT_FOUND
+        return max(0, min(timeout, float(request.headers["X-poll-timeout"])))
+    except (KeyError, ValueError):
+        return timeout
 
-    if ffile[0] != "/":
-        if not os.path.exists(os.path.join(current_app.instance_path, ffile)):
-            return {'firmware': "not found"}, status.HTTP_404_NOT_FOUND
-        else:
-            ffile = os.path.join(current_app.instance_path, ffile)
 
-    if ffile[0] == "/" and not os.path.exists(ffile):
-        return {'firmware': "not found"}, status.HTTP_404_NOT_FOUND
+@bp.route('/checkin')
+def checkin():
+    """Report which artifacts of a device are out of date
+
+    Takes the same version headers as the individual routes. Artifacts
+    whose version header is missing are not checked, unknown ones are
+    reported as null. Small local configs are inlined, the global config
+    is never decrypted here and has to be fetched with its key.
+    """
+    chip_id = request.headers.get("X-chip-id")
+    if not chip_id:
+        return {'checkin': 'no CHIP ID given'}, status.HTTP_404_NOT_FOUND
+
+    try:
+        j = _checkin_report(chip_id)
+    except (ValueError, TypeError):
+        return {'checkin': 'invalid version'}, status.HTTP_400_BAD_REQUEST
+
+    g.poll_pending = _pending(j)
+    return j, status.HTTP_200_OK
+
+
+@bp.route('/poll')
+def poll():
+    """Long-polling variant of the check-in
+
+    Answers at once if an artifact is out of date, otherwise waits for a
+    deploy affecting the device for up to X-poll-timeout seconds. A wait
+    that ends without a deploy is answered with 304.
+
+    Under the ASGI entry point the wait is handed back to the event loop
+    through the `iota.wait` environ entry, which then repeats the request.
+    Plain WSGI servers would block a thread instead, there the wait is
+    capped by LONGPOLL_SYNC_TIMEOUT, which answers at once by default.
+    """
+    chip_id = request.headers.get("X-chip-id")
+    if not chip_id:
+        return {'poll': 'no CHIP ID given'}, status.HTTP_404_NOT_FOUND
+
+    hub = get_hub()
+    # taken before the check, so a deploy in between ends the wait at once
+    since = hub.generations(_checkin_topics(chip_id))
+    try:
+        j = _checkin_report(chip_id)
+        if _pending(j):
+            g.poll_pending = True
+            return j, status.HTTP_200_OK
+
+        timeout = poll_timeout()
+        wait = request.environ.get("iota.wait")
+        if wait is None:
+            timeout = min(timeout,
+                          current_app.config["LONGPOLL_SYNC_TIMEOUT"])
+        elif since and timeout > 0:
+            wait.update(since=since, timeout=timeout)
+            return {}, status.HTTP_304_NOT_MODIFIED
+
+        if not since or not hub.wait(since, timeout):
+            return {}, status.HTTP_304_NOT_MODIFIED
 
-    with open(ffile, "rb") as f:
-        fw = f.read()
+        j = _checkin_report(chip_id)
+    except (ValueError, TypeError):
+        return {'poll': 'invalid version'}, status.HTTP_400_BAD_REQUEST
 
-    return fw, status.HTTP_200_OK
+    g.poll_pending = _pending(j)
+    return j, status.HTTP_200_OK
@@ -7,15 +7,27 @@
 #  https://flask.palletsprojects.com/en/1.1.x/tutorial/
 #
 import base64
+import click
+import collections
+import concurrent.futures
+import hashlib
+import hmac
+import json
 import nacl.pwhash
 import nacl.utils
+import os
 import re
 import sqlite3
+import threading
+import time
 
 from flask import (
     Blueprint,
+    current_app,
+    g,
     request,
 )
+from flask.cli import with_appcontext
 from flask_api import status
 
 from iota.db import get_db
@@ -23,51 +35,376 @@ from iota.db import get_db
 bp = Blueprint('token', __name__, url_prefix='/api/v1')
 
 
-def check_hash(token_name, token):
-    if not token_name or not token or len(token_name) == 0 or len(token) < 32:
-        return False
+class TokenCache:
+    """Bounded LRU cache of successfully verified tokens
+
+    Entries are keyed by a keyed BLAKE2b digest of the presented token, the
+    key is random and never leaves the process. Each entry maps to the token
+    name and its permission flags and expires after `ttl` seconds.
+
+    Every invalidation bumps the generation. Readers take it before fetching
+    a token from the database and hand it to put(), which drops the entry if
+    the token was changed in between.
+    """
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._key = nacl.utils.random(32)
+        self._entries = collections.OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _digest(self, token):
+        return hashlib.blake2b(token, key=self._key).digest()
+
+    def get(self, token):
+        if self.maxsize <= 0:
+            return None
+
+        digest = self._digest(token)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                return None
+            if entry[2] < time.monotonic():
+                del self._entries[digest]
+                return None
+            self._entries.move_to_end(digest)
+            return entry[0], entry[1]
+
+    def generation(self):
+        with self._lock:
+            return self._generation
+
+    def put(self, token, token_name, token_perm, generation=None):
+        if self.maxsize <= 0:
+            return
+
+        digest = self._digest(token)
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._entries[digest] = (token_name, token_perm,
+                                     time.monotonic() + self.ttl)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, token_name=None):
+        with self._lock:
+            self._generation += 1
+            if token_name is None:
+                self._entries.clear()
+                return
+            for digest in [d for d, e in self._entries.items()
+                           if e[0] == token_name]:
+                del self._entries[digest]
+
+
+def get_token_cache():
+    return current_app.extensions["iota_token_cache"]
+
+
+class PwhashBusy(Exception):
+    """Raised when the pwhash pool has no free slot"""
+
+
+class PwhashPool:
+    """Size-capped executor for argon2 hashing and verification
+
+    At most `workers` hashes run at the same time, which bounds the memory
+    argon2 allocates. Up to `max_inflight` hashes may be running or queued,
+    further submissions fail immediately with PwhashBusy.
+    """
+    def __init__(self, workers=2, max_inflight=16):
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="pwhash")
+        self._slots = threading.BoundedSemaphore(max_inflight)
+
+    def run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise PwhashBusy()
+
+        try:
+            future = self._executor.submit(fn, *args)
+        except RuntimeError:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        return future.result()
+
+
+def _whole_kib(memlimit):
+    # libsodium stores the memory limit of a hash in KiB
+    return memlimit - memlimit % 1024
+
+
+def pwhash_limits():
+    """Return the configured argon2id (opslimit, memlimit)"""
+    opslimit = current_app.config["PWHASH_OPSLIMIT"]
+    memlimit = current_app.config["PWHASH_MEMLIMIT"]
+    return (opslimit or nacl.pwhash.argon2id.OPSLIMIT_INTERACTIVE,
+            _whole_kib(memlimit or nacl.pwhash.argon2id.MEMLIMIT_INTERACTIVE))
+
+
+def pwhash_str(password):
+    opslimit, memlimit = pwhash_limits()
+    pool = current_app.extensions["iota_pwhash_pool"]
+    return pool.run(nacl.pwhash.argon2id.str, password, opslimit, memlimit)
+
+
+_ARGON2_PARAMS = re.compile(rb"^\$argon2id\$v=\d+\$m=(\d+),t=(\d+),")
+
+
+def pwhash_outdated(pwhash):
+    """Check whether a hash was created with other than the current limits"""
+    m = _ARGON2_PARAMS.match(pwhash)
+    if not m:
+        return True
+
+    opslimit, memlimit = pwhash_limits()
+    return int(m.group(2)) != opslimit or int(m.group(1)) * 1024 != memlimit
+
+
+def pwhash_verify(pwhash, password):
+    pool = current_app.extensions["iota_pwhash_pool"]
+    return pool.run(nacl.pwhash.verify, pwhash, password)
+
+
+def pwhash_busy(e):
+    return {"auth": "too many concurrent authentications"}, \
+        status.HTTP_503_SERVICE_UNAVAILABLE, \
+        {"Retry-After": str(current_app.config["PWHASH_RETRY_AFTER"])}
+
+
+def _as_bytes(value):
+    return value if isinstance(value, (bytes, bytearray)) \
+        else value.encode("utf-8")
+
+
+PERM_READ = 1
+PERM_WRITE = 2
+PERM_ADMIN = 4
+_PERM_FLAGS = {"r": PERM_READ, "w": PERM_WRITE, "a": PERM_ADMIN}
+
+
+def perm_flags(token_perm):
+    flags = 0
+    for p in token_perm:
+        flags |= _PERM_FLAGS.get(p, 0)
+    return flags
+
+
+def _permits(flags, access):
+    required = perm_flags(access)
+    return flags & PERM_ADMIN != 0 or \
+        (required != 0 and flags & required == required)
+
+
+def token_lookup(token):
+    """Non-secret lookup identifier of a token
+
+    Tokens carry 512 bits of randomness, so an unkeyed digest can be stored
+    next to the argon2 hash and indexed without weakening the token.
+    """
+    return hashlib.blake2b(_as_bytes(token), digest_size=16).hexdigest()
 
+
+def _verify_legacy(token, flags):
+    """Scan tokens created before lookup identifiers were introduced
+
+    Only rows granting `flags` are checked. A hit stores the lookup
+    identifier, so every legacy token is scanned for at most once.
+    """
     db = get_db()
-    result = db.execute("SELECT token FROM tokens WHERE name = ?",
-                        (token_name,)).fetchone()
+    result = db.execute("SELECT id, name, token, perm_flags FROM tokens \
+                        WHERE lookup IS NULL AND (perm_flags & ? = ? \
+                        OR perm_flags & ? != 0)",
+                        (flags, flags, PERM_ADMIN,)).fetchall()
 
-    if not result:
-        return False
+    for r in result:
+        try:
+            if pwhash_verify(_as_bytes(r["token"]), token):
+                db.execute("UPDATE tokens SET lookup = ? WHERE id = ?",
+                           (token_lookup(token), r["id"],))
+                db.commit()
+                return r
+        except nacl.exceptions.InvalidkeyError:
+            pass
+
+    return None
 
+
+def _rehash(r, token):
+    """Store a current hash of `token` unless the row changed meanwhile"""
+    db = get_db()
     try:
-        pwhash = result["token"] if \
-            isinstance(result["token"], (bytes, bytearray)) else \
-            result["token"].encode("utf-8")
-        token = token if isinstance(token, (bytes, bytearray)) \
-            else token.encode("utf-8")
-        return nacl.pwhash.verify(pwhash, token)
+        db.execute("UPDATE tokens SET token = ? WHERE id = ? AND token = ?",
+                   (pwhash_str(token), r["id"], r["token"],))
+        db.commit()
+    except PwhashBusy:
+        # the token is valid, it is rehashed on a later verification
+        pass
+    except sqlite3.Error as e:
+        print(e)
+
+
+Identity = collections.namedtuple("Identity", ["name", "flags", "session"],
+                                  defaults=(False,))
+
+SESSION_PREFIX = b"iota."
+
+
+def _session_key():
+    """Key of session bearers, None while sessions are not configured
+
+    Only a dedicated SESSION_KEY is used, never the Flask SECRET_KEY with
+    its well-known development default.
+    """
+    key = current_app.config["SESSION_KEY"]
+    if not key or _as_bytes(key) == b"dev":
+        return None
+    return _as_bytes(key)
+
+
+def _b64(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+
+def _unb64(data):
+    return base64.urlsafe_b64decode(data + b"=" * (-len(data) % 4))
+
+
+def new_session(identity, flags, ttl):
+    """Create a signed, short-lived bearer for an identity
+
+    Bearers are checked with an HMAC only, so every node sharing the
+    session key accepts them. They cannot be revoked before they expire.
+    """
+    expires = int(time.time()) + ttl
+    payload = _b64(json.dumps({"n": identity.name, "p": flags,
+                               "e": expires}).encode("utf-8"))
+    mac = hmac.new(_session_key(), payload, hashlib.sha256).digest()
+    return SESSION_PREFIX + payload + b"." + _b64(mac), expires
+
+
+def resolve_session(token):
+    key = _session_key()
+    if key is None:
+        return None
+
+    try:
+        payload, mac = token[len(SESSION_PREFIX):].split(b".")
+        expected = hmac.new(key, payload, hashlib.sha256).digest()
+        if not hmac.compare_digest(_unb64(mac), expected):
+            return None
+        j = json.loads(_unb64(payload).decode("utf-8"))
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+    if j["e"] < time.time():
+        return None
+
+    return Identity(j["n"], j["p"], True)
+
+
+def resolve(token):
+    """Return the Identity a token belongs to or None"""
+    if not token or len(token) < 32:
+        return None
+
+    token = _as_bytes(token)
+    if token.startswith(SESSION_PREFIX):
+        return resolve_session(token)
+
+    cache = get_token_cache()
+    cached = cache.get(token)
+    if cached:
+        return Identity(*cached)
+
+    generation = cache.generation()
+    db = get_db()
+    r = db.execute("SELECT id, name, token, perm_flags FROM tokens \
+                   WHERE lookup = ?", (token_lookup(token),)).fetchone()
+
+    if not r:
+        return None
+
+    try:
+        pwhash_verify(_as_bytes(r["token"]), token)
     except nacl.exceptions.InvalidkeyError:
-        return False
+        return None
+
+    return _verified(r, token, generation)
+
+
+def _verified(r, token, generation):
+    if pwhash_outdated(_as_bytes(r["token"])):
+        _rehash(r, token)
+
+    get_token_cache().put(token, r["name"], r["perm_flags"], generation)
+    return Identity(r["name"], r["perm_flags"])
+
+
+def resolve_legacy(token, access):
+    """Identity of a token without lookup identifier holding `access`
+
+    Scanning runs argon2 once per candidate row, so it is only done with
+    TOKEN_LEGACY_SCAN set, and misses are remembered per token and access.
+    """
+    if not current_app.config["TOKEN_LEGACY_SCAN"] or not token or \
+            len(token) < 32:
+        return None
+
+    token = _as_bytes(token)
+    if token.startswith(SESSION_PREFIX):
+        return None
+
+    misses = current_app.extensions["iota_token_misses"]
+    key = token + b"\0" + access.encode("utf-8")
+    if misses.get(key):
+        return None
+
+    generation = get_token_cache().generation()
+    r = _verify_legacy(token, perm_flags(access))
+    if not r:
+        misses.put(key, None, 0)
+        return None
+
+    return _verified(r, token, generation)
+
+
+def identify(token, access="r"):
+    """Return the Identity of a token, also looking for legacy tokens"""
+    identity = resolve(token)
+    if identity is None:
+        identity = resolve_legacy(token, access)
+    return identity
 
 
 def verify(token, access="r"):
     if not token or len(token) < 32 or not access or len(access) < 1:
         return False
 
-    db = get_db()
-    result = db.execute("SELECT name, token FROM tokens WHERE \
-                        permissions LIKE ? OR permissions LIKE '%%a%%'",
-                        ("%%" + access + "%%",)).fetchall()
+    identity = identify(token, access)
+    return identity is not None and _permits(identity.flags, access)
 
-    if not result:
-        return False
 
-    token = token if isinstance(token, (bytes, bytearray)) \
-        else token.encode("utf-8")
-    for r in result:
-        try:
-            pwhash = r["token"] if isinstance(r["token"], (bytes, bytearray))\
-                else r["token"].encode("utf-8")
-            return nacl.pwhash.verify(pwhash, token)
-        except nacl.exceptions.InvalidkeyError:
-            pass
+def load_auth():
+    """Resolve the X-auth-token of the current request exactly once"""
+    g.auth = resolve(request.headers.get("X-auth-token"))
 
-    return False
+
+def authorized(access):
+    """Check the identity resolved by load_auth() for an access right
+
+    Legacy tokens are only looked for by routes that require a right.
+    """
+    auth = g.get("auth")
+    if auth is None:
+        auth = g.auth = resolve_legacy(request.headers.get("X-auth-token"),
+                                       access)
+    return auth is not None and _permits(auth.flags, access)
 
 
 def show_token(token_name=None):
@@ -96,15 +433,19 @@ def new_token(token_name, token_perm):
     token = gen_token()
     token_perm = re.sub(r"[^arw]", "", token_perm)
     try:
-        db.execute("INSERT INTO tokens (name, token, permissions) \
-                    VALUES (?, ?, ?)",
-                   (token_name, nacl.pwhash.str(token), token_perm,))
+        db.execute("INSERT INTO tokens \
+                    (name, token, lookup, permissions, perm_flags) \
+                    VALUES (?, ?, ?, ?, ?)",
+                   (token_name, pwhash_str(token), token_lookup(token),
+                    token_perm, perm_flags(token_perm),))
         db.commit()
     except sqlite3.Error as e:
         print(e)
         return {"new_token": "token name already exists"},\
             status.HTTP_409_CONFLICT
 
+    get_token_cache().invalidate(token_name)
+
     return {"name": token_name,
             "token": token.decode(),
             "permissions": token_perm}, status.HTTP_201_CREATED
@@ -118,9 +459,10 @@ def update_token(token_name, token_perm, token_regen):
     if token_regen and token_perm and len(token_perm) > 0:
         token = gen_token()
         try:
-            db.execute("UPDATE tokens SET token = ?, permissions = ? \
-                        WHERE name = ?",
-                       (nacl.pwhash.str(token), token_perm, token_name,))
+            db.execute("UPDATE tokens SET token = ?, lookup = ?, \
+                        permissions = ?, perm_flags = ? WHERE name = ?",
+                       (pwhash_str(token), token_lookup(token),
+                        token_perm, perm_flags(token_perm), token_name,))
             db.commit()
         except sqlite3.Error as e:
             print(e)
@@ -128,16 +470,19 @@ def update_token(token_name, token_perm, token_regen):
     elif token_regen:
         token = gen_token()
         try:
-            db.execute("UPDATE tokens SET token = ? WHERE name = ?",
-                       (nacl.pwhash.str(token), token_name,))
+            db.execute("UPDATE tokens SET token = ?, lookup = ? \
+                        WHERE name = ?",
+                       (pwhash_str(token), token_lookup(token),
+                        token_name,))
             db.commit()
         except sqlite3.Error as e:
             print(e)
             return {}, status.HTTP_400_BAD_REQUEST
     elif token_perm and len(token_perm) > 0:
         try:
-            db.execute("UPDATE tokens SET permissions = ? WHERE name = ?",
-                       (token_perm, token_name,))
+            db.execute("UPDATE tokens SET permissions = ?, perm_flags = ? \
+                        WHERE name = ?",
+                       (token_perm, perm_flags(token_perm), token_name,))
             db.commit()
         except sqlite3.Error as e:
             print(e)
@@ -145,6 +490,8 @@ def update_token(token_name, token_perm, token_regen):
     else:
         return {}, status.HTTP_400_BAD_REQUEST
 
+    get_token_cache().invalidate(token_name)
+
     return {"name": token_name,
             "token": token if token_regen else "***",
             "permissions": token_perm if token_perm else "***"},\
@@ -161,13 +508,117 @@ def delete_token(token_name):
         print(e)
         return {}, status.HTTP_400_BAD_REQUEST
 
+    get_token_cache().invalidate(token_name)
+
     return {}, status.HTTP_202_ACCEPTED
 
 
+def _time_pwhash(opslimit, memlimit, rounds=3):
+    password = gen_token()
+    start = time.perf_counter()
+    for i in range(rounds):
+        pwhash = nacl.pwhash.argon2id.str(password, opslimit, memlimit)
+    nacl.pwhash.verify(pwhash, password)
+    return (time.perf_counter() - start) / (rounds + 1)
+
+
+def calibrate_pwhash(target, memlimit):
+    """Find argon2id limits that verify in about `target` seconds
+
+    The memory limit is halved until a single pass fits into the target,
+    then the number of passes is raised as long as it stays below.
+    """
+    opslimit = nacl.pwhash.argon2id.OPSLIMIT_MIN
+    memlimit = _whole_kib(memlimit)
+    while _time_pwhash(opslimit, memlimit) > target and \
+            memlimit // 2 >= nacl.pwhash.argon2id.MEMLIMIT_MIN:
+        memlimit = _whole_kib(memlimit // 2)
+
+    while _time_pwhash(opslimit + 1, memlimit) <= target:
+        opslimit += 1
+
+    return opslimit, memlimit
+
+
+def _write_config(config_file, settings):
+    lines = []
+    try:
+        with open(config_file, "r") as f:
+            lines = [line for line in f.read().splitlines()
+                     if line.split("=")[0].strip() not in settings]
+    except OSError:
+        pass
+
+    lines += ["%s = %d" % (k, v) for k, v in settings.items()]
+    with open(config_file, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+@click.command('calibrate-pwhash')
+@click.option('--target-ms', default=100, show_default=True,
+              help='Target verification latency in milliseconds.')
+@click.option('--memlimit', default=nacl.pwhash.argon2id.MEMLIMIT_INTERACTIVE,
+              show_default=True, help='Maximum memory per hash in bytes.')
+@click.option('--config', 'config_file', default=None,
+              help='Config file to update, the instance config by default.')
+@with_appcontext
+def calibrate_pwhash_command(target_ms, memlimit, config_file):
+    """Measure argon2id on this host and store the chosen limits."""
+    opslimit, memlimit = calibrate_pwhash(target_ms / 1000.0,
+                                          _whole_kib(memlimit))
+    if not config_file:
+        config_file = os.path.join(current_app.instance_path, "config.py")
+    _write_config(config_file, {"PWHASH_OPSLIMIT": opslimit,
+                                "PWHASH_MEMLIMIT": memlimit})
+    click.echo('PWHASH_OPSLIMIT = %d, PWHASH_MEMLIMIT = %d written to %s' %
+               (opslimit, memlimit, config_file))
+
+
+def init_app(app):
+    app.extensions["iota_token_cache"] = TokenCache(
+        maxsize=app.config["TOKEN_CACHE_SIZE"],
+        ttl=app.config["TOKEN_CACHE_TTL"])
+    app.extensions["iota_token_misses"] = TokenCache(
+        maxsize=app.config["TOKEN_CACHE_SIZE"],
+        ttl=app.config["TOKEN_CACHE_TTL"])
+    app.extensions["iota_pwhash_pool"] = PwhashPool(
+        workers=app.config["PWHASH_WORKERS"],
+        max_inflight=app.config["PWHASH_MAX_INFLIGHT"])
+    app.register_error_handler(PwhashBusy, pwhash_busy)
+    app.before_request(load_auth)
+    app.cli.add_command(calibrate_pwhash_command)
+
+
+@bp.route('/token/session', methods=['PUT'])
+def session():
+    if not authorized("r"):
+        # legacy tokens are only found by a right they hold
+        authorized("w")
+    if g.auth is None or g.auth.session:
+        return {}, status.HTTP_403_FORBIDDEN
+
+    if _session_key() is None:
+        return {"session": "sessions are not configured"}, \
+            status.HTTP_503_SERVICE_UNAVAILABLE
+
+    flags = g.auth.flags
+    content = request.get_json(silent=True)
+    if isinstance(content, dict) and "permissions" in content.keys():
+        if not isinstance(content["permissions"], str):
+            return {"session": "invalid permissions"}, \
+                status.HTTP_400_BAD_REQUEST
+        flags &= perm_flags(content["permissions"])
+
+    token, expires = new_session(g.auth, flags,
+                                 current_app.config["SESSION_TTL"])
+    return {"name": g.auth.name,
+            "token": token.decode(),
+            "expires": expires}, status.HTTP_201_CREATED
+
+
 @bp.route('/token', methods=['GET', 'PUT', 'UPDATE', 'DELETE'])
 def token():
-    token = request.headers.get("X-auth-token")
-    if not verify(token, "r"):
+    if not authorized("r"):
         return {}, status.HTTP_403_FORBIDDEN
 
     content = request.get_json()
@@ -183,18 +634,18 @@ def token():
             token_regen = True
 
     if request.method == "GET":
-        if verify(token, "a"):
+        if authorized("a"):
             return show_token(token_name)
-        if check_hash(token_name, token):
+        if token_name and g.auth.name == token_name:
             return show_token()
     elif request.method == "PUT":
-        if verify(token, "a") and token_name and token_perm:
+        if authorized("a") and token_name and token_perm:
             return new_token(token_name, token_perm)
     elif request.method == "UPDATE":
-        if verify(token, "a") and token_name and (token_perm or token_regen):
+        if authorized("a") and token_name and (token_perm or token_regen):
             return update_token(token_name, token_perm, token_regen)
     elif request.method == "DELETE":
-        if verify(token, "a") and token_name:
+        if authorized("a") and token_name:
             return delete_token(token_name)
     else:
         return {}, status.HTTP_404_NOT_FOUND
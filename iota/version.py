@@ -0,0 +1,116 @@
+#
+# (C) Copyright 2020 Tillmann Heidsieck
+#
+# SPDX-License-Identifier: MIT
+#
+"""Parsing and comparison of firmware version strings
+
+A version is reduced to the characters 0-9 . _ + -, split into components
+at "." and each component into sub-components at "_", "+" and "-". Numeric
+sub-components compare as integers.
+"""
+import functools
+import re
+
+_INVALID = re.compile(r"[^0-9._+-]")
+_SEPARATOR = re.compile(r"[_+-]")
+_NUMERIC = re.compile(r"[0-9]+")
+
+
+def _verprep(v):
+    return _INVALID.sub("", v.strip())
+
+
+def v2l(v):
+    return [[int(s) if _NUMERIC.match(s) else s
+             for s in _SEPARATOR.sub(".", c).split(".")]
+            for c in v.split(".")]
+
+
+@functools.lru_cache(maxsize=4096)
+def verkey(v):
+    """Parse a version string into the form compared by keycmp()"""
+    return tuple(tuple(c) for c in v2l(_verprep(v)))
+
+
+def keycmp(v1, v2):
+    """Compare two parsed versions
+
+    Returns 1 if v1 is older than v2, -1 if it is newer and 0 if both are
+    the same.
+    """
+    cmp = 0
+    for i in range(0, min(len(v1), len(v2))):
+        for j in range(0, min(len(v1[i]), len(v2[i]))):
+            if v1[i][j] < v2[i][j]:
+                cmp = 1
+                break
+            elif v1[i][j] > v2[i][j]:
+                cmp = -1
+                break
+        if cmp == 0 and len(v1[i]) != len(v2[i]):
+            cmp = 1 if len(v1) < len(v2) else -1
+        if cmp != 0:
+            break
+
+    if cmp == 0 and len(v1) == len(v2):
+        return 0
+    elif cmp == 0 and len(v1) != len(v2):
+        return 1 if len(v1) < len(v2) else -1
+    else:
+        return cmp
+
+
+def vercmp(v1, v2):
+    return keycmp(verkey(v1), verkey(v2))
+
+
+def _subkey(s):
+    # empty sub-components sort before every number
+    return -1 if s == "" else s
+
+
+@functools.total_ordering
+class VersionKey:
+    """Totally ordered, hashable firmware version
+
+    The order agrees with vercmp() wherever vercmp() is consistent. For
+    components that only differ in their number of sub-components within
+    versions of equal length vercmp() calls either side newer, here the
+    component with more sub-components is the newer one.
+    """
+    __slots__ = ("version", "key")
+
+    def __init__(self, version):
+        self.version = version
+        self.key = verkey(version)
+
+    def _cmp(self, other):
+        v1, v2 = self.key, other.key
+        for i in range(0, min(len(v1), len(v2))):
+            for j in range(0, min(len(v1[i]), len(v2[i]))):
+                a, b = _subkey(v1[i][j]), _subkey(v2[i][j])
+                if a != b:
+                    return -1 if a < b else 1
+            if len(v1[i]) != len(v2[i]):
+                if len(v1) != len(v2):
+                    return -1 if len(v1) < len(v2) else 1
+                return -1 if len(v1[i]) < len(v2[i]) else 1
+
+        return (len(v1) > len(v2)) - (len(v1) < len(v2))
+
+    def __eq__(self, other):
+        if not isinstance(other, VersionKey):
+            return NotImplemented
+        return self.key == other.key
+
+    def __lt__(self, other):
+        if not isinstance(other, VersionKey):
+            return NotImplemented
+        return self._cmp(other) < 0
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        return "VersionKey(%r)" % (self.version,)
@@ -21,7 +21,7 @@ setup(
     include_package_data=True,
     zip_safe=False,
     install_requires=["flask", "flask_api", "PyNaCl"],
-    extras_require={"test": ["pytest", "coverage"]},
+    extras_require={"test": ["pytest", "coverage"], "delta": ["bsdiff4"]},
     package_data={
         "iota" : ["schema.sql"],
     },
@@ -4,9 +4,15 @@
 # SPDX-License-Identifier: MIT
 #
 import base64
+import collections
+import hashlib
 import json
 import nacl.utils
 import os
+import pytest
+import shutil
+
+from iota.db import get_db
 
 TEST_ADMIN_TOKEN = \
     "QWw6kjrJY5xB4VSzWns+DZjM7Tda5CI9YlEmq43oTsQAeTHJpuG+gc4ZVr21hs+XkcXo5IQGix\
@@ -23,12 +29,13 @@ TEST_FIRMWARE_LENGTH = 512
 TEST_FIRMWARE_DATA = base64.b64encode(nacl.utils.random(TEST_FIRMWARE_LENGTH))
 
 
-def upload_firmware(client, version="v1.0", data=TEST_FIRMWARE_DATA):
-    headers = {
+def upload_firmware(client, version="v1.0", data=TEST_FIRMWARE_DATA,
+                    headers={}):
+    headers = dict({
         "X-auth-token": TEST_WRITER_TOKEN,
         "X-firmware-version": version,
         "Content-Type": "text/plain",
-    }
+    }, **headers)
     return client.put('/api/v1/deploy/firmware', headers=headers, data=data)
 
 
@@ -172,16 +179,17 @@ def test_token_delete(client):
 
 
 def test_deploy_local_config(client, app):
-    local_config_file = os.path.join(os.path.dirname(__file__), "..",
-                                     "instance", "config.json.0x00000001")
-    if os.path.exists(local_config_file):
-        os.unlink(local_config_file)
-
     reply = upload_local_config(client)
     assert reply.status_code == 201
     assert b"successfully" in reply.data
 
-    os.unlink(local_config_file)
+    reply = upload_local_config(client)
+    assert reply.status_code == 201
+
+    with app.app_context():
+        r = get_db().execute("SELECT config_version FROM local_configs \
+                             WHERE chip_id = '0x00000001'").fetchone()
+        assert r["config_version"] == 2
 
 
 def test_deploy_global_config(client):
@@ -195,41 +203,35 @@ def test_deploy_global_config(client):
     assert b"successfully" in reply.data
 
     os.unlink(global_config_file)
+    os.unlink(global_config_file + ".meta")
 
 
 def test_deploy_firmware(client):
-    firmware_sig_file = os.path.join(os.path.dirname(__file__), "..",
-                                     "instance", "firmware.sig")
-    firmware_json_file = os.path.join(os.path.dirname(__file__), "..",
-                                      "instance", "firmware.json")
-    if os.path.exists(firmware_sig_file):
-        os.unlink(firmware_sig_file)
-    if os.path.exists(firmware_json_file):
-        os.unlink(firmware_json_file)
+    firmware_dir = os.path.join(os.path.dirname(__file__), "..",
+                                "instance", "firmware")
+    shutil.rmtree(firmware_dir, ignore_errors=True)
 
     reply = upload_firmware(client)
     assert reply.status_code == 201
     assert b"successfully" in reply.data
 
+    firmware_sig_file = os.path.join(
+        firmware_dir,
+        hashlib.sha256(base64.b64decode(TEST_FIRMWARE_DATA)).hexdigest() +
+        ".sig")
     with open(firmware_sig_file, "rb") as f:
         firmware = f.read()
 
     assert len(firmware) == TEST_FIRMWARE_LENGTH
     assert base64.b64encode(firmware) == TEST_FIRMWARE_DATA
 
-    os.unlink(firmware_sig_file)
-    os.unlink(firmware_json_file)
-
+    reply = upload_firmware(client)
+    assert reply.status_code == 304
 
-def test_get_local_config(client):
-    local_config_file = os.path.join(os.path.dirname(__file__), "..",
-                                     "instance", "config.json.0x00000001")
+    shutil.rmtree(firmware_dir)
 
-    try:
-        os.unlink(local_config_file)
-    except OSError:
-        pass
 
+def test_get_local_config(client):
     upload_local_config(client, version=1, chip_id="0x00000001")
 
     hdrs = {
@@ -241,10 +243,9 @@ def test_get_local_config(client):
     resp = json.loads(reply.data.decode('utf8'))
     assert resp["config_version"] == 1
 
-    try:
-        os.unlink(local_config_file)
-    except OSError:
-        pass
+    hdrs["X-config-version"] = 1
+    reply = client.get('/api/v1/local_config', headers=hdrs)
+    assert reply.status_code == 404
 
 
 def test_get_global_config(client):
@@ -264,15 +265,14 @@ def test_get_global_config(client):
 
     try:
         os.unlink(global_config_file)
+        os.unlink(global_config_file + ".meta")
     except OSError:
         pass
 
 
 def test_get_firmware(client):
-    firmware_sig_file = os.path.join(os.path.dirname(__file__), "..",
-                                     "instance", "firmware.sig")
-    firmware_json_file = os.path.join(os.path.dirname(__file__), "..",
-                                      "instance", "firmware.json")
+    firmware_dir = os.path.join(os.path.dirname(__file__), "..",
+                                "instance", "firmware")
     upload_firmware(client, data=TEST_FIRMWARE_DATA)
     hdrs = {
         'X-ESP8266-version': 'v0.1',
@@ -281,8 +281,1287 @@ def test_get_firmware(client):
     assert reply.status_code == 200
     assert len(reply.data) == TEST_FIRMWARE_LENGTH
     assert base64.b64encode(reply.data) == TEST_FIRMWARE_DATA
-    try:
-        os.unlink(firmware_sig_file)
-        os.unlink(firmware_json_file)
-    except OSError:
+    shutil.rmtree(firmware_dir, ignore_errors=True)
+
+
+def test_token_cache(app, monkeypatch):
+    import nacl.pwhash
+    from iota.token import delete_token, verify
+
+    calls = []
+    pwhash_verify = nacl.pwhash.verify
+
+    def counting_verify(pwhash, token):
+        calls.append(pwhash)
+        return pwhash_verify(pwhash, token)
+
+    monkeypatch.setattr(nacl.pwhash, "verify", counting_verify)
+
+    with app.app_context():
+        assert verify(TEST_READER_TOKEN, "r")
+        hashes = len(calls)
+        assert verify(TEST_READER_TOKEN, "r")
+        assert not verify(TEST_READER_TOKEN, "w")
+        assert len(calls) == hashes
+
+        delete_token("reader")
+        assert not verify(TEST_READER_TOKEN, "r")
+
+
+def test_token_cache_race(app, monkeypatch):
+    import nacl.pwhash
+    from iota.token import get_token_cache, verify
+
+    pwhash_verify = nacl.pwhash.verify
+
+    with app.app_context():
+        cache = get_token_cache()
+
+        def racing_verify(pwhash, token):
+            # the token is changed while its old row is being verified
+            cache.invalidate("writer")
+            return pwhash_verify(pwhash, token)
+
+        monkeypatch.setattr(nacl.pwhash, "verify", racing_verify)
+        assert verify(TEST_WRITER_TOKEN, "w")
+        monkeypatch.undo()
+        assert not cache.get(TEST_WRITER_TOKEN.encode())
+
+        assert verify(TEST_WRITER_TOKEN, "w")
+        assert cache.get(TEST_WRITER_TOKEN.encode())
+
+
+def test_token_legacy_lookup(app, monkeypatch):
+    from iota.token import get_token_cache, verify
+
+    calls = []
+    pwhash_verify = nacl.pwhash.verify
+
+    def counting_verify(pwhash, token):
+        calls.append(token)
+        return pwhash_verify(pwhash, token)
+
+    monkeypatch.setattr(nacl.pwhash, "verify", counting_verify)
+
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE tokens SET lookup = NULL \
+                   WHERE name IN ('reader', 'writer')")
+        db.commit()
+
+        assert not verify(TEST_WRITER_TOKEN, "w")
+        assert not calls
+
+        app.config["TOKEN_LEGACY_SCAN"] = True
+        # only rows granting the requested right are checked
+        assert verify(TEST_WRITER_TOKEN, "w")
+        assert len(calls) == 1
+        assert not verify(TEST_WRITER_TOKEN, "a")
+
+        r = db.execute("SELECT lookup FROM tokens WHERE name = 'writer'")\
+            .fetchone()
+        assert r["lookup"] is not None
+
+        get_token_cache().invalidate()
+        assert verify(TEST_WRITER_TOKEN, "r")
+
+        # misses are not scanned again
+        calls.clear()
+        bogus = "x" * 40
+        assert not verify(bogus, "r")
+        assert not verify(bogus, "r")
+        assert len(calls) == 1
+
+
+def test_auth_context(app):
+    from flask import g
+    from iota.token import authorized, load_auth
+
+    hdrs = {"X-auth-token": TEST_WRITER_TOKEN}
+    with app.test_request_context('/api/v1/token', headers=hdrs):
+        load_auth()
+        assert g.auth.name == "writer"
+        assert authorized("r")
+        assert authorized("w")
+        assert not authorized("a")
+
+    with app.test_request_context('/api/v1/token'):
+        load_auth()
+        assert g.auth is None
+        assert not authorized("r")
+
+
+def test_pwhash_pool_busy(app, client):
+    from iota.token import PwhashPool
+
+    app.extensions["iota_pwhash_pool"] = PwhashPool(max_inflight=0)
+    reply = client.get('/api/v1/token',
+                       headers={"X-auth-token": TEST_ADMIN_TOKEN})
+    assert reply.status_code == 503
+    assert reply.headers["Retry-After"] == "1"
+
+
+def test_pwhash_rehash(app, monkeypatch):
+    import iota.token
+    from iota.token import PwhashBusy, get_token_cache, verify
+
+    app.config["PWHASH_OPSLIMIT"] = 1
+    app.config["PWHASH_MEMLIMIT"] = 8192 + 100
+    with app.app_context():
+        assert verify(TEST_READER_TOKEN, "r")
+        r = get_db().execute("SELECT token FROM tokens WHERE name = 'reader'")\
+            .fetchone()
+        assert r["token"].decode().startswith("$argon2id$v=19$m=8,t=1,")
+
+        # limits that are not whole KiB do not cause a rehash every time
+        def no_rehash(token):
+            raise AssertionError("must not rehash")
+
+        monkeypatch.setattr(iota.token, "pwhash_str", no_rehash)
+        get_token_cache().invalidate()
+        assert verify(TEST_READER_TOKEN, "r")
+
+        # a busy pool skips the rehash instead of failing the request
+        def busy(token):
+            raise PwhashBusy()
+
+        monkeypatch.setattr(iota.token, "pwhash_str", busy)
+        app.config["PWHASH_OPSLIMIT"] = 2
+        get_token_cache().invalidate()
+        assert verify(TEST_READER_TOKEN, "r")
+
+        # a token regenerated during the rehash keeps its new hash
+        def regenerated(token):
+            get_db().execute("UPDATE tokens SET token = ? \
+                             WHERE name = 'reader'", (b"regenerated",))
+            return b"rehashed"
+
+        monkeypatch.setattr(iota.token, "pwhash_str", regenerated)
+        get_token_cache().invalidate()
+        assert verify(TEST_READER_TOKEN, "r")
+        r = get_db().execute("SELECT token FROM tokens WHERE name = 'reader'")\
+            .fetchone()
+        assert r["token"] == b"regenerated"
+
+
+def test_calibrate_pwhash(runner, tmp_path):
+    config_file = str(tmp_path / "config.py")
+    with open(config_file, "w") as f:
+        f.write("SECRET_KEY = 'test'\nPWHASH_OPSLIMIT = 99\n")
+
+    result = runner.invoke(args=["calibrate-pwhash", "--target-ms", "1",
+                                 "--memlimit", "65536",
+                                 "--config", config_file])
+    assert result.exit_code == 0
+
+    config = {}
+    with open(config_file) as f:
+        exec(f.read(), config)
+    assert config["SECRET_KEY"] == "test"
+    assert config["PWHASH_OPSLIMIT"] >= 1
+    assert config["PWHASH_MEMLIMIT"] <= 65536
+
+
+def test_token_session(app, client, monkeypatch):
+    import nacl.pwhash
+
+    hdrs = {
+        "X-auth-token": TEST_WRITER_TOKEN,
+        "Content-Type": "application/json",
+    }
+    reply = client.put('/api/v1/token/session', headers=hdrs,
+                       data=json.dumps({"permissions": "w"}))
+    assert reply.status_code == 503
+
+    app.config["SESSION_KEY"] = "test session key"
+    reply = client.put('/api/v1/token/session', headers=hdrs,
+                       data=json.dumps({"permissions": "w"}))
+    assert reply.status_code == 201
+    session = json.loads(reply.data.decode("utf-8"))["token"]
+
+    def no_verify(pwhash, token):
+        raise AssertionError("session bearer must not hit argon2")
+
+    monkeypatch.setattr(nacl.pwhash, "verify", no_verify)
+
+    with app.test_request_context('/'):
+        from iota.token import resolve
+        identity = resolve(session)
+        assert identity.name == "writer"
+        assert identity.session
+        assert not resolve(session[:-4] + "AAAA")
+
+    hdrs["X-auth-token"] = session
+    hdrs["X-chip-id"] = "0x00000002"
+    reply = client.put('/api/v1/deploy/local_config', headers=hdrs,
+                       data=json.dumps({"name": "test sensor"}))
+    assert reply.status_code == 201
+
+    reply = client.put('/api/v1/token/session', headers=hdrs)
+    assert reply.status_code == 403
+
+
+def test_token_session_write_only(app, client):
+    from iota.token import new_token
+
+    app.config["SESSION_KEY"] = "test session key"
+    with app.app_context():
+        deployer = new_token("deployer", "w")[0]["token"]
+
+    hdrs = {
+        "X-auth-token": deployer,
+        "Content-Type": "application/json",
+    }
+    reply = client.put('/api/v1/token/session', headers=hdrs,
+                       data=json.dumps({"permissions": ["w"]}))
+    assert reply.status_code == 400
+
+    reply = client.put('/api/v1/token/session', headers=hdrs,
+                       data=json.dumps({"permissions": "rw"}))
+    assert reply.status_code == 201
+
+    # legacy tokens without lookup identifier are found as well
+    app.config["TOKEN_LEGACY_SCAN"] = True
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE tokens SET lookup = NULL WHERE name = 'deployer'")
+        db.commit()
+
+    reply = client.put('/api/v1/token/session', headers=hdrs)
+    assert reply.status_code == 201
+    session = json.loads(reply.data.decode("utf-8"))["token"]
+
+    with app.test_request_context('/'):
+        from iota.token import PERM_WRITE, resolve
+        identity = resolve(session)
+        assert identity.name == "deployer"
+        assert identity.flags == PERM_WRITE
+
+
+def test_get_firmware_range(client):
+    firmware_dir = os.path.join(os.path.dirname(__file__), "..",
+                                "instance", "firmware")
+    upload_firmware(client, data=TEST_FIRMWARE_DATA)
+    firmware = base64.b64decode(TEST_FIRMWARE_DATA)
+
+    hdrs = {
+        'X-ESP8266-version': 'v0.1',
+        'Range': 'bytes=100-',
+    }
+    reply = client.get('/api/v1/firmware', headers=hdrs)
+    assert reply.status_code == 206
+    assert reply.headers["Accept-Ranges"] == "bytes"
+    assert reply.data == firmware[100:]
+
+    shutil.rmtree(firmware_dir, ignore_errors=True)
+
+
+def test_etag(client):
+    instance = os.path.join(os.path.dirname(__file__), "..", "instance")
+    artifacts = ["global_config.enc", "global_config.enc.meta"]
+
+    upload_firmware(client, data=TEST_FIRMWARE_DATA)
+    upload_local_config(client, chip_id="0x00000001")
+    upload_global_config(client)
+
+    requests = [
+        ('/api/v1/firmware', {'X-ESP8266-version': 'v0.1'}),
+        ('/api/v1/local_config', {'X-chip-id': '0x00000001',
+                                  'X-config-version': 0}),
+        ('/api/v1/global_config', {
+            'X-global-config-version': 0,
+            'X-global-config-key': TEST_GLOBAL_CONFIG_KEY}),
+    ]
+    for url, hdrs in requests:
+        reply = client.get(url, headers=hdrs)
+        assert reply.status_code == 200
+        etag = reply.headers["ETag"]
+
+        hdrs["If-None-Match"] = etag
+        reply = client.get(url, headers=hdrs)
+        assert reply.status_code == 304
+        assert reply.headers["ETag"] == etag
+
+    for a in artifacts:
+        try:
+            os.unlink(os.path.join(instance, a))
+        except OSError:
+            pass
+    shutil.rmtree(os.path.join(instance, "firmware"), ignore_errors=True)
+
+
+def test_firmware_catalog_cache(client, monkeypatch):
+    instance = os.path.join(os.path.dirname(__file__), "..", "instance")
+    upload_firmware(client, version="v1.2", data=TEST_FIRMWARE_DATA)
+    reply = client.get('/api/v1/firmware',
+                       headers={'X-ESP8266-version': 'v1.2'})
+    assert reply.status_code == 304
+
+    def no_fs(*args, **kwargs):
+        raise AssertionError("manifest must be served from memory")
+
+    monkeypatch.setattr(os, "stat", no_fs)
+    monkeypatch.setattr("builtins.open", no_fs)
+    reply = client.get('/api/v1/firmware',
+                       headers={'X-ESP8266-version': 'v1.2'})
+    assert reply.status_code == 304
+    monkeypatch.undo()
+
+    shutil.rmtree(os.path.join(instance, "firmware"))
+
+
+VERSION_CORPUS = [
+    "0.0", "v0.1", "v1.0", "1.0", " v1.0 ", "1.0.0", "1.0.1", "1.1",
+    "1.10", "1.9", "1.0-1", "1.0-2", "1.0_rc1", "1.0+build7", "1.0-1-1",
+    "2", "2.0", "10.0", "v2.0.0-beta", "1.0.0.0", "0.9.99", "1", "",
+    "1-1", "1.2.3-4+5", "release-3.2", "3.2", "1..2", "1.3.2",
+]
+
+
+def _reference_vercmp(v1, v2):
+    import re
+
+    def verprep(v):
+        v = v.lstrip().rstrip()
+        v = re.sub(r"[^0-9._+-]+?", "", v)
+        return v
+
+    def v2l(v):
+        as_list = v.split(".")
+        for i in range(0, len(as_list)):
+            as_list[i] = re.sub(r"[_+-]+?", ".", as_list[i])
+            as_list[i] = as_list[i].split(".")
+
+        for i in range(0, len(as_list)):
+            for j in range(0, len(as_list[i])):
+                if re.match(r"[0-9]+", as_list[i][j]):
+                    as_list[i][j] = int(as_list[i][j])
+
+        return as_list
+
+    v1 = v2l(verprep(v1))
+    v2 = v2l(verprep(v2))
+
+    cmp = 0
+    for i in range(0, min(len(v1), len(v2))):
+        for j in range(0, min(len(v1[i]), len(v2[i]))):
+            if v1[i][j] < v2[i][j]:
+                cmp = 1
+                break
+            elif v1[i][j] > v2[i][j]:
+                cmp = -1
+                break
+        if cmp == 0 and len(v1[i]) != len(v2[i]):
+            cmp = 1 if len(v1) < len(v2) else -1
+        if cmp != 0:
+            break
+
+    if cmp == 0 and len(v1) == len(v2):
+        return 0
+    elif cmp == 0 and len(v1) != len(v2):
+        return 1 if len(v1) < len(v2) else -1
+    else:
+        return cmp
+
+
+def test_vercmp_equivalence():
+    import pytest
+    from iota.deploy import vercmp
+    from iota.version import VersionKey
+
+    for v1 in VERSION_CORPUS:
+        for v2 in VERSION_CORPUS:
+            try:
+                expected = _reference_vercmp(v1, v2)
+            except TypeError:
+                with pytest.raises(TypeError):
+                    vercmp(v1, v2)
+                continue
+
+            assert vercmp(v1, v2) == expected, (v1, v2)
+            if expected == -_reference_vercmp(v2, v1):
+                k1, k2 = VersionKey(v1), VersionKey(v2)
+                assert (k1 < k2) == (expected == 1), (v1, v2)
+                assert (k1 == k2) == (expected == 0), (v1, v2)
+
+    ordered = sorted(VERSION_CORPUS, key=VersionKey)
+    for older, newer in zip(ordered, ordered[1:]):
+        assert VersionKey(older) <= VersionKey(newer)
+
+
+def test_firmware_channels(client):
+    instance = os.path.join(os.path.dirname(__file__), "..", "instance")
+    beta = base64.b64encode(nacl.utils.random(TEST_FIRMWARE_LENGTH))
+
+    upload_firmware(client, version="v1.0")
+    hdrs = {
+        "X-auth-token": TEST_WRITER_TOKEN,
+        "X-firmware-version": "v1.1",
+        "X-firmware-channel": "beta",
+        "Content-Type": "text/plain",
+    }
+    reply = client.put('/api/v1/deploy/firmware', headers=hdrs, data=beta)
+    assert reply.status_code == 201
+
+    hdrs = {'X-ESP8266-version': 'v0.1'}
+    reply = client.get('/api/v1/firmware', headers=hdrs)
+    assert base64.b64encode(reply.data) == TEST_FIRMWARE_DATA
+
+    hdrs["X-firmware-channel"] = "beta"
+    reply = client.get('/api/v1/firmware', headers=hdrs)
+    assert base64.b64encode(reply.data) == beta
+
+    hdrs["X-firmware-model"] = "esp32"
+    reply = client.get('/api/v1/firmware', headers=hdrs)
+    assert reply.status_code == 404
+
+    shutil.rmtree(os.path.join(instance, "firmware"))
+
+
+def test_import_firmware(app, runner):
+    instance = app.instance_path
+    with open(os.path.join(instance, "firmware.sig"), "wb") as f:
+        f.write(base64.b64decode(TEST_FIRMWARE_DATA))
+    with open(os.path.join(instance, "firmware.json"), "w") as f:
+        json.dump({"version": "v1.0", "file": "firmware.sig"}, f)
+
+    result = runner.invoke(args=["import-firmware"])
+    assert result.exit_code == 0
+
+    with app.app_context():
+        from iota.firmware import newest_firmware
+        manifest = newest_firmware("esp8266", "stable")
+        assert manifest.version == "v1.0"
+        assert manifest.size == TEST_FIRMWARE_LENGTH
+
+    os.unlink(os.path.join(instance, "firmware.sig"))
+    os.unlink(os.path.join(instance, "firmware.json"))
+    shutil.rmtree(os.path.join(instance, "firmware"))
+
+
+def test_firmware_delta(client):
+    import pytest
+    bsdiff4 = pytest.importorskip("bsdiff4")
+
+    instance = os.path.join(os.path.dirname(__file__), "..", "instance")
+    old = nacl.utils.random(4 * TEST_FIRMWARE_LENGTH)
+    new = old[:1000] + b"patched" + old[1007:]
+
+    upload_firmware(client, version="v1.0", data=base64.b64encode(old))
+    reply = upload_firmware(client, version="v1.1", data=base64.b64encode(new))
+    assert json.loads(reply.data.decode("utf-8"))["deltas"] == 1
+
+    hdrs = {
+        'X-ESP8266-version': 'v1.0',
+        'X-firmware-delta': 'bsdiff4',
+    }
+    reply = client.get('/api/v1/firmware', headers=hdrs)
+    assert reply.status_code == 200
+    assert reply.headers["X-firmware-delta-source"] == "v1.0"
+    assert len(reply.data) < len(new)
+    assert bsdiff4.patch(old, reply.data) == new
+
+    hdrs['X-ESP8266-version'] = 'v0.9'
+    reply = client.get('/api/v1/firmware', headers=hdrs)
+    assert "X-firmware-delta" not in reply.headers
+    assert reply.data == new
+
+    shutil.rmtree(os.path.join(instance, "firmware"))
+
+
+def test_firmware_gzip(client):
+    import gzip
+
+    instance = os.path.join(os.path.dirname(__file__), "..", "instance")
+    image = b"\x00\x01\x02\x03" * TEST_FIRMWARE_LENGTH
+
+    reply = upload_firmware(client, data=base64.b64encode(image))
+    assert reply.status_code == 201
+    assert json.loads(reply.data.decode("utf-8"))["compression"]["gzip"] < 1
+
+    hdrs = {
+        'X-ESP8266-version': 'v0.1',
+        'Accept-Encoding': 'gzip',
+    }
+    reply = client.get('/api/v1/firmware', headers=hdrs)
+    assert reply.status_code == 200
+    assert reply.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(reply.data) == image
+
+    del hdrs['Accept-Encoding']
+    reply = client.get('/api/v1/firmware', headers=hdrs)
+    assert "Content-Encoding" not in reply.headers
+    assert reply.data == image
+
+    shutil.rmtree(os.path.join(instance, "firmware"))
+
+
+def test_deploy_firmware_streaming(client, monkeypatch):
+    import iota.firmware
+
+    firmware_dir = os.path.join(os.path.dirname(__file__), "..",
+                                "instance", "firmware")
+    monkeypatch.setattr(iota.firmware, "CHUNK_SIZE", 7)
+    image = nacl.utils.random(TEST_FIRMWARE_LENGTH)
+
+    encoded = base64.encodebytes(image)
+    reply = upload_firmware(client, version="v1.0", data=encoded)
+    assert reply.status_code == 201
+
+    reply = upload_firmware(client, version="v1.1", data=encoded[:-2])
+    assert reply.status_code == 400
+
+    hdrs = {
+        "X-auth-token": TEST_WRITER_TOKEN,
+        "X-firmware-version": "v1.1",
+        "Content-Type": "application/octet-stream",
+    }
+    reply = client.put('/api/v1/deploy/firmware', headers=hdrs,
+                       data=image[::-1])
+    assert reply.status_code == 201
+
+    assert not [f for f in os.listdir(firmware_dir) if f.endswith(".part")]
+    for data in [image, image[::-1]]:
+        name = hashlib.sha256(data).hexdigest() + ".sig"
+        with open(os.path.join(firmware_dir, name), "rb") as f:
+            assert f.read() == data
+
+    shutil.rmtree(firmware_dir)
+
+
+def test_deploy_firmware_resumable(client):
+    instance = os.path.join(os.path.dirname(__file__), "..", "instance")
+    image = nacl.utils.random(3 * TEST_FIRMWARE_LENGTH)
+    chunks = [image[i:i + TEST_FIRMWARE_LENGTH]
+              for i in range(0, len(image), TEST_FIRMWARE_LENGTH)]
+    auth = {"X-auth-token": TEST_WRITER_TOKEN}
+
+    hdrs = dict(auth, **{"X-firmware-version": "v2.0"})
+    reply = client.post('/api/v1/deploy/firmware/upload', headers=hdrs)
+    assert reply.status_code == 201
+    url = '/api/v1/deploy/firmware/upload/' + \
+        json.loads(reply.data.decode("utf-8"))["upload"]
+
+    for n in [2, 0]:
+        hdrs = dict(auth, **{
+            "X-chunk-digest": hashlib.sha256(chunks[n]).hexdigest(),
+            "Content-Type": "application/octet-stream",
+        })
+        reply = client.put('%s/%d' % (url, n), headers=hdrs, data=chunks[n])
+        assert reply.status_code == 201
+
+    hdrs["X-chunk-digest"] = hashlib.sha256(b"other").hexdigest()
+    reply = client.put(url + '/1', headers=hdrs, data=chunks[1])
+    assert reply.status_code == 400
+
+    reply = client.get(url, headers=auth)
+    assert json.loads(reply.data.decode("utf-8"))["chunks"] == [0, 2]
+
+    reply = client.post(url + '/commit', headers=auth)
+    assert reply.status_code == 409
+
+    hdrs["X-chunk-digest"] = hashlib.sha256(chunks[1]).hexdigest()
+    reply = client.put(url + '/1', headers=hdrs, data=chunks[1])
+    assert reply.status_code == 201
+
+    hdrs = dict(auth, **{
+        "X-firmware-digest": hashlib.sha256(image).hexdigest(),
+    })
+    reply = client.post(url + '/commit', headers=hdrs)
+    assert reply.status_code == 201
+    assert client.get(url, headers=auth).status_code == 404
+
+    reply = client.get('/api/v1/firmware',
+                       headers={'X-ESP8266-version': 'v1.0'})
+    assert reply.data == image
+
+    shutil.rmtree(os.path.join(instance, "firmware"))
+    shutil.rmtree(os.path.join(instance, "uploads"))
+
+
+def test_deploy_firmware_upload_limits(app, client):
+    auth = {"X-auth-token": TEST_WRITER_TOKEN}
+    hdrs = dict(auth, **{"X-firmware-version": "v2.0"})
+    uploads = os.path.join(app.instance_path, "uploads")
+
+    def create():
+        reply = client.post('/api/v1/deploy/firmware/upload', headers=hdrs)
+        if reply.status_code != 201:
+            return reply.status_code
+        return json.loads(reply.data.decode("utf-8"))["upload"]
+
+    app.config["UPLOAD_MAX_SESSIONS"] = 2
+    first, second = create(), create()
+    assert create() == 429
+
+    # broken uploads are dropped instead of failing with 500
+    with open(os.path.join(uploads, first, "upload.json"), "w") as f:
+        f.write("{")
+    url = '/api/v1/deploy/firmware/upload/'
+    assert client.post(url + first + '/commit', headers=auth)\
+        .status_code == 404
+    assert not os.path.exists(os.path.join(uploads, first))
+
+    app.config["UPLOAD_MAX_SIZE"] = 10
+    data = b"x" * 11
+    chunk = dict(auth, **{"X-chunk-digest": hashlib.sha256(data).hexdigest()})
+    reply = client.put(url + second + '/0', headers=chunk, data=data)
+    assert reply.status_code == 413
+
+    # expired uploads are removed when the next one is created
+    app.config["UPLOAD_TTL"] = -1
+    third = create()
+    assert not os.path.exists(os.path.join(uploads, second))
+    assert client.get(url + third, headers=auth).status_code == 404
+    assert os.listdir(uploads) == []
+
+    shutil.rmtree(uploads)
+
+
+def test_deploy_local_config_concurrent(app):
+    import threading
+
+    def deploy():
+        upload_local_config(app.test_client(), chip_id="0x00000003")
+
+    threads = [threading.Thread(target=deploy) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    with app.app_context():
+        from iota.local_config import local_config_meta
+        assert local_config_meta("0x00000003")["config_version"] == 8
+
+
+def test_global_config_without_decryption(client, monkeypatch):
+    import nacl.secret
+
+    global_config_file = os.path.join(os.path.dirname(__file__), "..",
+                                      "instance", "global_config.enc")
+    upload_global_config(client)
+    hdrs = {
+        "X-global-config-version": 0,
+        "X-global-config-key": TEST_GLOBAL_CONFIG_KEY,
+    }
+    reply = client.get('/api/v1/global_config', headers=hdrs)
+    assert reply.status_code == 200
+
+    def no_decrypt(*args, **kwargs):
+        raise AssertionError("must not decrypt")
+
+    monkeypatch.setattr(nacl.secret.SecretBox, "decrypt", no_decrypt)
+
+    reply = client.get('/api/v1/global_config', headers=hdrs)
+    assert reply.status_code == 200
+    assert json.loads(reply.data.decode("utf-8"))["global_config_version"] \
+        == 1
+
+    hdrs["X-global-config-version"] = 1
+    reply = client.get('/api/v1/global_config', headers=hdrs)
+    assert reply.status_code == 404
+
+    os.unlink(global_config_file)
+    os.unlink(global_config_file + ".meta")
+
+
+def test_import_local_configs(app, runner):
+    local_config_file = os.path.join(app.instance_path,
+                                     "config.json.0x00000004")
+    with open(local_config_file, "w") as f:
+        json.dump({"name": "test sensor", "config_version": 5}, f)
+
+    result = runner.invoke(args=["import-local-configs"])
+    assert result.exit_code == 0
+    os.unlink(local_config_file)
+
+    with app.app_context():
+        from iota.local_config import local_config_meta
+        assert local_config_meta("0x00000004")["config_version"] == 5
+
+    reply = upload_local_config(app.test_client(), chip_id="0x00000004")
+    assert reply.status_code == 201
+    with app.app_context():
+        assert local_config_meta("0x00000004")["config_version"] == 6
+
+
+def test_deploy_local_config_bulk(app, client, monkeypatch):
+    import iota.deploy
+
+    monkeypatch.setattr(iota.deploy, "CHUNK_SIZE", 5)
+    app.config["LOCAL_CONFIG_BULK_BATCH"] = 2
+    upload_local_config(client, chip_id="0x00000005")
+
+    hdrs = {
+        "X-auth-token": TEST_WRITER_TOKEN,
+        "Content-Type": "application/json",
+    }
+    entries = [{"chip_id": "0x0000000%d" % (i), "config": {"name": "ü"}}
+               for i in range(5, 8)]
+    entries.append({"chip_id": "0x00000008", "config": "invalid"})
+    reply = client.put('/api/v1/deploy/local_config/bulk', headers=hdrs,
+                       data=json.dumps(entries))
+    assert reply.status_code == 200
+    results = json.loads(reply.data.decode("utf-8"))["local_config"]
+    assert [r.get("config_version") for r in results] == [2, 1, 1, None]
+
+    hdrs["Content-Type"] = "application/x-ndjson"
+    data = "\n".join(json.dumps(e) for e in entries[:2]) + "\n"
+    reply = client.put('/api/v1/deploy/local_config/bulk', headers=hdrs,
+                       data=data)
+    results = json.loads(reply.data.decode("utf-8"))["local_config"]
+    assert [r["config_version"] for r in results] == [3, 2]
+
+    reply = client.put('/api/v1/deploy/local_config/bulk', headers=hdrs,
+                       data=data + "{")
+    assert reply.status_code == 400
+    with app.app_context():
+        from iota.local_config import local_config_meta
+        assert local_config_meta("0x00000005")["config_version"] == 3
+
+    # the body is read before the write transaction begins
+    bulk_entries = iota.deploy._bulk_entries
+
+    def unlocked_entries(*args):
+        for entry in bulk_entries(*args):
+            assert not get_db().in_transaction
+            yield entry
+
+    monkeypatch.setattr(iota.deploy, "_bulk_entries", unlocked_entries)
+    reply = client.put('/api/v1/deploy/local_config/bulk', headers=hdrs,
+                       data=data)
+    assert reply.status_code == 200
+
+    hdrs["X-auth-token"] = TEST_READER_TOKEN
+    reply = client.put('/api/v1/deploy/local_config/bulk', headers=hdrs,
+                       data=data)
+    assert reply.status_code == 401
+
+
+def test_deploy_local_config_bulk_strict(app, client, monkeypatch):
+    import io
+    import iota.deploy
+    from iota.deploy import EntryTooLarge, _json_array_entries
+
+    monkeypatch.setattr(iota.deploy, "CHUNK_SIZE", 3)
+
+    def decode(body, max_entry=100):
+        return list(_json_array_entries(io.BytesIO(body.encode()), max_entry))
+
+    assert decode(' [ {"a": [1, 2]} , 12345, -0.5e3, "x"\n] \n') == \
+        [{"a": [1, 2]}, 12345, -500.0, "x"]
+    assert decode("[]") == []
+    for body in ("[1 2]", "[1,]", "[,1]", "[1] x", "[1][2]", "{}", "[1",
+                 ""):
+        with pytest.raises(ValueError):
+            decode(body)
+    with pytest.raises(EntryTooLarge):
+        decode('[1, "%s"]' % ("x" * 100))
+
+    # a large element is not decoded again for every read
+    decode_calls = []
+    raw_decode = json.JSONDecoder.raw_decode
+
+    def counting_decode(self, s, idx=0):
+        decode_calls.append(idx)
+        return raw_decode(self, s, idx)
+
+    monkeypatch.setattr(json.JSONDecoder, "raw_decode", counting_decode)
+    decode('["%s"]' % ("x" * 3000), max_entry=4096)
+    assert len(decode_calls) < 15
+
+    app.config["LOCAL_CONFIG_BULK_MAX_ENTRY"] = 64
+    hdrs = {
+        "X-auth-token": TEST_WRITER_TOKEN,
+        "Content-Type": "application/json",
+    }
+    entry = {"chip_id": "0x0000000a", "config": {"name": "x" * 64}}
+    reply = client.put('/api/v1/deploy/local_config/bulk', headers=hdrs,
+                       data=json.dumps([entry]))
+    assert reply.status_code == 413
+
+    hdrs["Content-Type"] = "application/x-ndjson"
+    reply = client.put('/api/v1/deploy/local_config/bulk', headers=hdrs,
+                       data=json.dumps(entry) + "\n")
+    assert reply.status_code == 413
+
+    with app.app_context():
+        from iota.local_config import local_config_meta
+        assert not local_config_meta("0x0000000a")
+
+
+def test_read_during_bulk_deploy(app, client):
+    import threading
+    from iota.local_config import store_local_configs
+
+    upload_local_config(client, chip_id="0x0000000b")
+    hdrs = {"X-chip-id": "0x0000000b", "X-config-version": "0"}
+    replies = []
+
+    def read():
+        try:
+            replies.append(client.get('/api/v1/local_config', headers=hdrs))
+        except Exception as e:
+            replies.append(e)
+
+    def entries():
+        # a small page cache makes the writer spill to the database file
+        get_db().execute("PRAGMA cache_size = 10")
+        for i in range(500):
+            yield "0x1%07x" % (i), {"name": "x" * 500}
+
+        t = threading.Thread(target=read)
+        t.start()
+        t.join()
+
+    with app.app_context():
+        store_local_configs(entries(), 100)
+
+    assert replies[0].status_code == 200
+    j = json.loads(replies[0].data.decode("utf-8"))
+    assert j["config_version"] == 1
+
+
+def test_checkin(app, client):
+    global_config_file = os.path.join(app.instance_path, "global_config.enc")
+    upload_firmware(client, version="v1.0")
+    upload_local_config(client, chip_id="0x00000009")
+    upload_global_config(client)
+
+    hdrs = {
+        "X-chip-id": "0x00000009",
+        "X-ESP8266-version": "v0.9",
+        "X-config-version": 0,
+        "X-global-config-version": 1,
+    }
+    reply = client.get('/api/v1/checkin', headers=hdrs)
+    assert reply.status_code == 200
+    j = json.loads(reply.data.decode("utf-8"))
+    assert j["firmware"]["update"]
+    assert j["firmware"]["version"] == "v1.0"
+    assert j["firmware"]["size"] == TEST_FIRMWARE_LENGTH
+    assert j["local_config"]["update"]
+    assert j["local_config"]["config"] == {"name": "test sensor",
+                                           "config_version": 1}
+    assert not j["global_config"]["update"]
+    assert j["global_config"]["size"] > 0
+
+    app.config["CHECKIN_INLINE_MAX"] = 0
+    hdrs["X-ESP8266-version"] = "v1.0"
+    del hdrs["X-global-config-version"]
+    reply = client.get('/api/v1/checkin', headers=hdrs)
+    j = json.loads(reply.data.decode("utf-8"))
+    assert not j["firmware"]["update"]
+    assert "config" not in j["local_config"]
+    assert "global_config" not in j
+
+    hdrs["X-config-version"] = "x"
+    reply = client.get('/api/v1/checkin', headers=hdrs)
+    assert reply.status_code == 400
+
+    hdrs["X-config-version"] = 0
+    for version in ("dev", "1..0"):
+        hdrs["X-ESP8266-version"] = version
+        reply = client.get('/api/v1/checkin', headers=hdrs)
+        assert reply.status_code == 400
+        reply = client.get('/api/v1/poll', headers=hdrs)
+        assert reply.status_code == 400
+        reply = client.get('/api/v1/firmware', headers=hdrs)
+        assert reply.status_code == 400
+
+    os.unlink(global_config_file)
+    os.unlink(global_config_file + ".meta")
+    shutil.rmtree(os.path.join(app.instance_path, "firmware"))
+
+
+def test_poll(app, client):
+    import threading
+
+    hdrs = {
+        "X-chip-id": "0x0000000a",
+        "X-config-version": 0,
+        "X-poll-timeout": 0,
+    }
+    reply = client.get('/api/v1/poll', headers=hdrs)
+    assert reply.status_code == 304
+
+    def deploy():
+        upload_local_config(app.test_client(), chip_id="0x0000000a")
+
+    # WSGI threads are not held by default
+    hdrs["X-poll-timeout"] = 10
+    reply = client.get('/api/v1/poll', headers=hdrs)
+    assert reply.status_code == 304
+
+    app.config["LONGPOLL_SYNC_TIMEOUT"] = 10
+    timer = threading.Timer(0.1, deploy)
+    timer.start()
+    reply = client.get('/api/v1/poll', headers=hdrs)
+    timer.join()
+    assert reply.status_code == 200
+    j = json.loads(reply.data.decode("utf-8"))
+    assert j["local_config"]["config_version"] == 1
+
+    # out of date devices are answered without waiting
+    reply = client.get('/api/v1/poll', headers=hdrs)
+    assert reply.status_code == 200
+
+
+def test_notification_hub_async():
+    import asyncio
+    from iota.notify import NotificationHub, local_config_topic
+
+    hub = NotificationHub()
+    topic = local_config_topic("0x0000000b")
+
+    async def waiters():
+        since = hub.generations([topic])
+        assert not await hub.wait_async(since, 0.01)
+
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.01, hub.signal, local_config_topic("other"))
+        loop.call_later(0.02, hub.signal, topic)
+        assert await hub.wait_async(since, 10)
+        assert await hub.wait_async(since, 0)
+
+    asyncio.run(waiters())
+    assert not hub._futures
+
+
+def asgi_request(asgi, method, path, headers={}, body=()):
+    """Run one request through an ASGI app, returns status, headers, body"""
+    import asyncio
+
+    scope = {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "query_string": b"",
+        "headers": [(k.lower().encode(), str(v).encode())
+                    for k, v in headers.items()],
+    }
+    messages = [{"type": "http.request", "body": b, "more_body": True}
+                for b in body]
+    messages.append({"type": "http.request", "body": b""})
+    sent = []
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await asyncio.sleep(3600)
+
+    async def send(message):
+        sent.append(message)
+
+    async def run():
+        await asgi(scope, receive, send)
+        return sent
+
+    return run()
+
+
+async def asgi_reply(request):
+    sent = await request
+    assert sent[-1] == {"type": "http.response.body", "body": b""}
+    headers = {k.decode(): v.decode() for k, v in sent[0]["headers"]}
+    return sent[0]["status"], headers, \
+        b"".join(m.get("body", b"") for m in sent[1:])
+
+
+def test_asgi(app, monkeypatch):
+    import asyncio
+    import iota.firmware
+    from iota.asgi import AsgiApp
+
+    monkeypatch.setattr(iota.firmware, "CHUNK_SIZE", 100)
+    asgi = AsgiApp(app, threads=1)
+    writer = {"X-auth-token": TEST_WRITER_TOKEN}
+    image = nacl.utils.random(TEST_FIRMWARE_LENGTH)
+
+    async def requests():
+        status, _, body = await asgi_reply(asgi_request(
+            asgi, "GET", "/api/v1"))
+        assert (status, body) == (200, b"Hello, World!")
+
+        status, _, _ = await asgi_reply(asgi_request(
+            asgi, "PUT", "/api/v1/deploy/firmware",
+            dict(writer, **{"X-firmware-version": "v1.0",
+                            "Content-Type": "application/octet-stream"}),
+            [image[:200], image[200:]]))
+        assert status == 201
+
+        status, headers, body = await asgi_reply(asgi_request(
+            asgi, "GET", "/api/v1/firmware", {"X-ESP8266-version": "v0.9"}))
+        assert status == 200
+        assert headers["etag"] == '"%s"' % hashlib.sha256(image).hexdigest()
+        assert body == image
+
+        # the long poll does not hold the only thread while waiting
+        hdrs = {"X-chip-id": "0x0000000c", "X-config-version": 0,
+                "X-poll-timeout": 10}
+        poll = asyncio.ensure_future(asgi_reply(asgi_request(
+            asgi, "GET", "/api/v1/poll", hdrs)))
+        await asyncio.sleep(0.1)
+        assert not poll.done()
+        status, _, _ = await asgi_reply(asgi_request(
+            asgi, "PUT", "/api/v1/deploy/local_config",
+            dict(writer, **{"X-chip-id": "0x0000000c",
+                            "Content-Type": "application/json"}),
+            [b'{"name": ', b'"test sensor"}']))
+        assert status == 201
+
+        status, _, body = await asyncio.wait_for(poll, 10)
+        assert status == 200
+        assert json.loads(body)["local_config"]["config_version"] == 1
+
+        hdrs["X-config-version"] = 1
+        hdrs["X-poll-timeout"] = 0.05
+        status, _, _ = await asgi_reply(asgi_request(
+            asgi, "GET", "/api/v1/poll", hdrs))
+        assert status == 304
+
+    asyncio.run(requests())
+    asgi.executor.shutdown()
+    shutil.rmtree(os.path.join(app.instance_path, "firmware"))
+
+
+def test_firmware_rollout(app, client):
+    from iota.firmware import eligible, rollout_percent
+
+    image = nacl.utils.random(TEST_FIRMWARE_LENGTH)
+    upload_firmware(client, version="v1.0")
+    reply = upload_firmware(client, version="v1.1",
+                            data=base64.b64encode(image),
+                            headers={"X-firmware-rollout": "50,100"})
+    assert reply.status_code == 201
+    rollout = json.loads(reply.data.decode("utf-8"))["rollout"]
+    assert rollout["percent"] == 50
+
+    reply = upload_firmware(client, version="v1.2",
+                            headers={"X-firmware-rollout": "50,10"})
+    assert reply.status_code == 400
+
+    def versions():
+        served = []
+        for i in range(200):
+            reply = client.get('/api/v1/firmware', headers={
+                "X-ESP8266-version": "v0.9", "X-chip-id": "0x%08x" % (i)})
+            served.append(reply.data == image)
+        return served
+
+    first = versions()
+    assert 60 < sum(first) < 140
+    assert versions() == first
+
+    writer = {"X-auth-token": TEST_WRITER_TOKEN}
+    reply = client.put('/api/v1/deploy/firmware/rollout', headers=writer,
+                       json={"version": "v1.1"})
+    assert reply.status_code == 200
+    assert json.loads(reply.data.decode("utf-8"))["rollout"]["percent"] \
+        == 100
+    assert all(versions())
+
+    reply = client.put('/api/v1/deploy/firmware/rollout', headers=writer,
+                       json={"version": "v1.1", "stage": 2})
+    assert reply.status_code == 400
+    reply = client.put('/api/v1/deploy/firmware/rollout', headers=writer,
+                       json={"version": "v9.9"})
+    assert reply.status_code == 404
+
+    # scheduled stages advance lazily
+    with app.app_context():
+        from iota.firmware import newest_firmware
+        manifest = newest_firmware("esp8266", "stable")
+        manifest = manifest._replace(rollout=manifest.rollout._replace(
+            stages=(1.0, 10.0, 100.0), stage=0, interval=60, started=0))
+    assert rollout_percent(manifest, now=59) == 1
+    assert rollout_percent(manifest, now=60) == 10
+    assert rollout_percent(manifest, now=10 ** 6) == 100
+    assert sum(eligible(manifest, "0x%08x" % (i), now=60)
+               for i in range(1000)) < 200
+
+    shutil.rmtree(os.path.join(app.instance_path, "firmware"))
+
+
+def test_firmware_admission(app, client):
+    limiter = app.extensions["iota_transfers"]
+    limiter.max_transfers = 1
+    upload_firmware(client, version="v1.0")
+    hdrs = {"X-ESP8266-version": "v0.9"}
+
+    reply = client.get('/api/v1/firmware', headers=hdrs, buffered=False)
+    assert reply.status_code == 200
+    busy = client.get('/api/v1/firmware', headers=hdrs)
+    assert busy.status_code == 503
+    assert 1 <= int(busy.headers["Retry-After"]) <= 31
+
+    reader = {"X-auth-token": TEST_READER_TOKEN}
+    j = json.loads(client.get('/api/v1/firmware/transfers',
+                              headers=reader).data.decode("utf-8"))
+    assert (j["active"], j["admitted"], j["rejected"]) == (1, 1, 1)
+    assert j["bytes"] == TEST_FIRMWARE_LENGTH
+
+    # the slot is released once the transfer is done
+    reply.close()
+    assert limiter.active == 0
+    reply = client.get('/api/v1/firmware', headers=hdrs)
+    assert reply.status_code == 200
+    reply.close()
+    assert limiter.active == 0
+
+    # up to date devices are not counted
+    hdrs["X-ESP8266-version"] = "v1.0"
+    assert client.get('/api/v1/firmware', headers=hdrs).status_code == 304
+
+    limiter.max_transfers = None
+    limiter.rate = TEST_FIRMWARE_LENGTH // 2
+    hdrs["X-ESP8266-version"] = "v0.9"
+    reply = client.get('/api/v1/firmware', headers=hdrs)
+    assert reply.status_code == 200
+    reply.close()
+    assert client.get('/api/v1/firmware', headers=hdrs).status_code == 503
+
+    assert client.get('/api/v1/firmware/transfers').status_code == 401
+
+    # the server still gets its own file wrapper to sendfile() from
+    from werkzeug.test import EnvironBuilder
+    from werkzeug.wsgi import FileWrapper
+
+    class ServerFileWrapper(FileWrapper):
+        pass
+
+    def start_response(status, headers):
         pass
+
+    limiter.rate = None
+    for max_transfers in (None, 1):
+        limiter.max_transfers = max_transfers
+        environ = EnvironBuilder('/api/v1/firmware', headers=hdrs)\
+            .get_environ()
+        environ["wsgi.file_wrapper"] = ServerFileWrapper
+        body = app(environ, start_response)
+        assert isinstance(body, ServerFileWrapper)
+        assert os.fstat(body.file.fileno()).st_size == TEST_FIRMWARE_LENGTH
+        assert limiter.active == (1 if max_transfers else 0)
+        body.close()
+        body.close()
+        assert limiter.active == 0
+
+    shutil.rmtree(os.path.join(app.instance_path, "firmware"))
+
+
+def test_poll_policy():
+    from iota.poll import PollContext, default_poll_policy
+
+    def ctx(chip_id, now=0, rate=0, pending=False):
+        return PollContext(chip_id, now, rate, pending, 300, 30, 10)
+
+    assert default_poll_policy(ctx("0x00000001", pending=True)) == 30
+    assert default_poll_policy(ctx(None)) == 300
+    assert default_poll_policy(ctx(None, rate=20)) == 600
+
+    # devices polling at the same time are spread over the interval
+    delays = [default_poll_policy(ctx("0x%08x" % (i), now=1000))
+              for i in range(1000)]
+    assert all(30 <= d <= 330 for d in delays)
+    slots = collections.Counter(
+        (1000 + d) % 300 // 30 for d in delays)
+    assert len(slots) == 10
+    assert max(slots.values()) < 150
+
+    # the next poll of a device falls into the same slot
+    d = default_poll_policy(ctx("0x00000001", now=1000))
+    d2 = default_poll_policy(ctx("0x00000001", now=1000 + d))
+    assert d2 == 300
+
+
+def test_poll_interval_header(app, client):
+    reply = client.get('/api/v1/firmware')
+    assert 30 <= int(reply.headers["X-poll-interval"]) <= 330
+
+    upload_local_config(client, chip_id="0x0000000d")
+    reply = client.get('/api/v1/checkin', headers={
+        "X-chip-id": "0x0000000d", "X-config-version": 0})
+    assert reply.headers["X-poll-interval"] == "30"
+
+    app.extensions["iota_poll_policy"] = lambda ctx: 42
+    reply = client.get('/api/v1/local_config')
+    assert reply.headers["X-poll-interval"] == "42"
+
+
+def test_token_session_default_key(app, client):
+    import hmac
+    import time
+
+    # a bearer forged with the development SECRET_KEY must not pass
+    payload = base64.urlsafe_b64encode(json.dumps(
+        {"n": "admin", "p": 7, "e": int(time.time()) + 300}).encode())\
+        .rstrip(b"=")
+    mac = base64.urlsafe_b64encode(
+        hmac.new(b"dev", payload, hashlib.sha256).digest()).rstrip(b"=")
+    forged = (b"iota." + payload + b"." + mac).decode()
+
+    hdrs = {"X-auth-token": forged, "Content-Type": "application/json"}
+    reply = client.put('/api/v1/token', headers=hdrs,
+                       data=json.dumps({"name": "evil", "permissions": "arw"}))
+    assert reply.status_code == 403
+
+    app.config["SESSION_KEY"] = "dev"
+    reply = client.put('/api/v1/token', headers=hdrs,
+                       data=json.dumps({"name": "evil", "permissions": "arw"}))
+    assert reply.status_code == 403
+
+
+def test_write_atomic_sync(client, monkeypatch, tmp_path):
+    from iota.files import write_atomic
+
+    synced = []
+    fsync = os.fsync
+
+    def counting_fsync(fd):
+        synced.append(os.readlink("/proc/self/fd/%d" % (fd)))
+        return fsync(fd)
+
+    monkeypatch.setattr(os, "fsync", counting_fsync)
+
+    path = str(tmp_path / "config")
+    write_atomic(path, b"new")
+    with open(path, "rb") as f:
+        assert f.read() == b"new"
+    assert len(synced) == 1 and synced[0] != path
+    assert os.listdir(str(tmp_path)) == ["config"]
+
+    # images are on the disk before they are renamed into place
+    synced.clear()
+    assert upload_firmware(client).status_code == 201
+    assert synced and all(f.endswith(".part") for f in synced)
+    shutil.rmtree(os.path.join(os.path.dirname(__file__), "..",
+                               "instance", "firmware"), ignore_errors=True)
+
+
+def test_publish_conflict_cleanup(app, client, monkeypatch):
+    import io
+    import iota.firmware
+    from iota.firmware import VersionConflict, add_firmware, firmware_dir
+
+    upload_firmware(client, version="v1.0")
+    with app.app_context():
+        published = sorted(os.listdir(firmware_dir()))
+
+        # another deploy wins between the early and the final version check
+        query_newest = iota.firmware.query_newest
+        calls = []
+
+        def racing_query_newest(model, channel):
+            calls.append(model)
+            return None if len(calls) == 1 else query_newest(model, channel)
+
+        monkeypatch.setattr(iota.firmware, "query_newest",
+                            racing_query_newest)
+        image = io.BytesIO(bytes(4 * TEST_FIRMWARE_LENGTH))
+        with pytest.raises(VersionConflict):
+            add_firmware("esp8266", "stable", "v0.9", image)
+        assert sorted(os.listdir(firmware_dir())) == published
+
+    shutil.rmtree(os.path.join(app.instance_path, "firmware"))
@@ -1,2 +1,2 @@
-INSERT INTO tokens (name, token, permissions) VALUES ("reader", "$argon2id$v=19$m=65536,t=2,p=1$v9ktkjwulylx3XwTj++osA$tpS6GLFS6ktcxbtkn39cobeDddY4rs1Y0Q9IvRX8KC8", "r");
-INSERT INTO tokens (name, token, permissions) VALUES ("writer", "$argon2id$v=19$m=65536,t=2,p=1$1jNegtzg7aeyE/DEAK+tfw$DpXwcqe9XIM21wFpVwCD7ycBrhBjgmHBdbIBH5NTTbE", "rw");
+INSERT INTO tokens (name, token, lookup, permissions, perm_flags) VALUES ("reader", "$argon2id$v=19$m=65536,t=2,p=1$v9ktkjwulylx3XwTj++osA$tpS6GLFS6ktcxbtkn39cobeDddY4rs1Y0Q9IvRX8KC8", "ad449756db6f5abf35da60c2e53f3375", "r", 1);
+INSERT INTO tokens (name, token, lookup, permissions, perm_flags) VALUES ("writer", "$argon2id$v=19$m=65536,t=2,p=1$1jNegtzg7aeyE/DEAK+tfw$DpXwcqe9XIM21wFpVwCD7ycBrhBjgmHBdbIBH5NTTbE", "327a2a4b7d17643b8e7b901874a492ef", "rw", 3);